@@ -0,0 +1,102 @@
+"""Pure-ASGI CORS middleware for a fixed set of allowed origins."""
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Request headers browsers may always send without being listed in
+# Access-Control-Allow-Headers (same set Starlette's CORSMiddleware allows).
+SAFELISTED_HEADERS = frozenset({"accept", "accept-language", "content-language", "content-type"})
+
+
+class StaticCORSMiddleware:
+    """CORS for a static origin allow-list, with every response header precomputed.
+
+    Requests without an ``Origin`` header (health checks, curl, server-to-server)
+    pass straight through.  Simple requests from an allowed origin get
+    ``Access-Control-Allow-Origin``/``Vary`` appended; preflights are answered
+    here with 204, or 400 if the origin, method or headers are not allowed.
+    A ``"*"`` entry allows every origin and answers with
+    ``Access-Control-Allow-Origin: *``, as Starlette's ``CORSMiddleware`` does.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        allow_origins: list[str],
+        allow_methods: list[str],
+        allow_headers: list[str],
+        max_age: int = 600,
+    ) -> None:
+        self.app = app
+        self._allow_all = "*" in allow_origins
+        self._origins = frozenset(o.encode("latin-1") for o in allow_origins if o != "*")
+        self._methods = frozenset(m.upper() for m in allow_methods)
+        self._headers = SAFELISTED_HEADERS | {h.lower() for h in allow_headers}
+        self._preflight_headers = [
+            (b"access-control-allow-methods", ", ".join(sorted(self._methods)).encode("latin-1")),
+            (b"access-control-allow-headers", ", ".join(sorted(self._headers)).encode("latin-1")),
+            (b"access-control-max-age", str(max_age).encode("latin-1")),
+            (b"vary", b"Origin"),
+        ]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        origin = request_method = request_headers = None
+        for name, value in scope["headers"]:
+            if name == b"origin":
+                origin = value
+            elif name == b"access-control-request-method":
+                request_method = value
+            elif name == b"access-control-request-headers":
+                request_headers = value
+
+        if origin is None:
+            await self.app(scope, receive, send)
+            return
+
+        if scope["method"] == "OPTIONS" and request_method is not None:
+            await self._preflight(origin, request_method, request_headers, send)
+            return
+
+        if self._allow_all:
+            cors_headers = [(b"access-control-allow-origin", b"*")]
+        elif origin in self._origins:
+            cors_headers = [(b"access-control-allow-origin", origin), (b"vary", b"Origin")]
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cors(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), *cors_headers]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+    async def _preflight(
+        self, origin: bytes, request_method: bytes, request_headers: bytes | None, send: Send
+    ) -> None:
+        failures = []
+        if not self._allow_all and origin not in self._origins:
+            failures.append("origin")
+        if request_method.decode("latin-1").upper() not in self._methods:
+            failures.append("method")
+        if request_headers:
+            requested = {h.strip().lower() for h in request_headers.decode("latin-1").split(",") if h.strip()}
+            if not requested <= self._headers:
+                failures.append("headers")
+
+        if failures:
+            status = 400
+            headers = [(b"content-type", b"text/plain; charset=utf-8")]
+            body = f"Disallowed CORS {', '.join(failures)}".encode()
+        else:
+            status = 204
+            allow_origin = b"*" if self._allow_all else origin
+            headers = [(b"access-control-allow-origin", allow_origin), *self._preflight_headers]
+            body = b""
+
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
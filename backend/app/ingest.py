@@ -1,9 +1,13 @@
 """Ingestion script: loads markdown files, chunks them, embeds via OpenAI, stores in ChromaDB."""
 
+import asyncio
+import hashlib
 import logging
 import os
 import re
+import sqlite3
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
@@ -24,11 +28,94 @@ except ImportError:
     print("Error: chromadb is not installed. Install it with: pip install chromadb")
     sys.exit(1)
 
+try:
+    import numpy as np
+except ImportError:
+    print("Error: numpy is not installed. Install it with: pip install numpy")
+    sys.exit(1)
+
+try:
+    from openai import (
+        APIConnectionError,
+        APITimeoutError,
+        AsyncOpenAI,
+        InternalServerError,
+        RateLimitError,
+    )
+except ImportError:
+    print("Error: openai is not installed. Install it with: pip install openai")
+    sys.exit(1)
+
+try:
+    from tenacity import (
+        AsyncRetrying,
+        retry_if_exception_type,
+        stop_after_attempt,
+        wait_random_exponential,
+    )
+except ImportError:
+    print("Error: tenacity is not installed. Install it with: pip install tenacity")
+    sys.exit(1)
+
 DOCS_DIR = Path(__file__).resolve().parent.parent / "docs"
 CHROMA_DIR = Path(__file__).resolve().parent.parent / "chroma_db"
+EMBEDDING_CACHE_PATH = Path(__file__).resolve().parent.parent / "embedding_cache.db"
 COLLECTION_NAME = "internal_docs"
+# HNSW index settings, applied when the collection is (re)created.  Must match
+# HNSW_METADATA in main.py (checked by the test suite).  Cosine space makes
+# ``1 - distance`` a cosine similarity; M=24 with construction_ef=128 and
+# search_ef=100 trades a larger graph and a few more visits per query for
+# near-exact recall at top_k <= 20.
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 24,
+    "hnsw:construction_ef": 128,
+    "hnsw:search_ef": 100,
+}
 EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "text-embedding-3-small")
 MAX_CHUNK_CHARS = 1500
+# A chunk shorter than this absorbs the next paragraph even if that overshoots
+# MAX_CHUNK_CHARS, so runs of tiny paragraphs don't each become a vector
+MIN_CHUNK_CHARS = 512
+
+_PARAGRAPH_BREAK_RE = re.compile(r"\n{2,}")
+_H2_RE = re.compile(r"^## .+$", re.MULTILINE)
+
+# Thread pool size for reading markdown files
+READ_WORKERS = 16
+
+
+def _positive_int_env(name: str, default: int) -> int:
+    """Read a positive integer from the environment, warning and using ``default`` if invalid."""
+    raw = os.environ.get(name)
+    if raw is None:
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        value = 0
+    if value <= 0:
+        logger.warning("Invalid %s value %r. Falling back to default %d.", name, raw, default)
+        return default
+    return value
+
+
+# Records per collection.upsert call (capped at the client's max batch size)
+UPSERT_BATCH_SIZE = _positive_int_env("CHROMA_BATCH_SIZE", 250)
+
+# Chunks per embeddings request, and how many requests may be in flight at once
+EMBEDDING_BATCH_SIZE = _positive_int_env("EMBEDDING_BATCH_SIZE", 500)
+EMBEDDING_CONCURRENCY = _positive_int_env("EMBEDDING_CONCURRENCY", 8)
+# Total characters per embeddings request.  Chunks can exceed MAX_CHUNK_CHARS
+# (oversized paragraphs, short-chunk merges) and length sorting puts the
+# longest together, so a count cap alone can overrun the per-request token
+# limit; 400k chars stays under it even at ~1.5 chars per token.
+EMBEDDING_BATCH_MAX_CHARS = _positive_int_env("EMBEDDING_BATCH_MAX_CHARS", 400_000)
+
+# A batch that hits a rate limit or transient error is retried on its own,
+# with jittered exponential backoff, instead of failing the whole ingest
+EMBEDDING_RETRYABLE = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+EMBEDDING_MAX_ATTEMPTS = 5
 
 
 def load_markdown_files(docs_dir: Path) -> list[dict]:
@@ -36,9 +123,14 @@ def load_markdown_files(docs_dir: Path) -> list[dict]:
 
     Returns a list of dicts with keys: ``filename``, ``relative_path``, ``content``.
     """
+    files = sorted(docs_dir.glob("**/*.md"))
+    # Reads are I/O-bound, so a thread pool overlaps them instead of blocking
+    # on each file in turn; map() keeps results in sorted-file order.
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as pool:
+        texts = list(pool.map(lambda p: p.read_text(encoding="utf-8"), files))
+
     documents = []
-    for md_file in sorted(docs_dir.glob("**/*.md")):
-        text = md_file.read_text(encoding="utf-8")
+    for md_file, text in zip(files, texts):
         documents.append({
             "filename": md_file.name,
             "relative_path": str(md_file.relative_to(docs_dir)),
@@ -54,20 +146,25 @@ def _split_by_headings(text: str) -> list[tuple[str, str]]:
     content before the first ``## `` heading (e.g. front-matter or the
     ``# Title`` line).
     """
-    pattern = re.compile(r"^(## .+)$", re.MULTILINE)
-    parts = pattern.split(text)
-
     sections: list[tuple[str, str]] = []
-    # parts alternates: [pre-text, heading1, body1, heading2, body2, ...]
-    # First element is everything before the first ## heading
-    preamble = parts[0].strip()
-    if preamble:
-        sections.append(("", preamble))
-
-    for i in range(1, len(parts), 2):
-        heading = parts[i].strip()
-        body = parts[i + 1].strip() if i + 1 < len(parts) else ""
+    heading = None
+    prev_end = 0
+    # Single pass over the heading matches; bodies are sliced straight out of
+    # ``text`` rather than materialising re.split's alternating parts list.
+    for m in _H2_RE.finditer(text):
+        body = text[prev_end:m.start()].strip()
+        if heading is not None:
+            sections.append((heading, body))
+        elif body:
+            sections.append(("", body))
+        heading = m.group().strip()
+        prev_end = m.end()
+
+    body = text[prev_end:].strip()
+    if heading is not None:
         sections.append((heading, body))
+    elif body:
+        sections.append(("", body))
 
     return sections
 
@@ -82,42 +179,52 @@ def _extract_title(text: str) -> str:
 
 
 def _split_section_by_paragraphs(
-    section_text: str, title: str, heading: str, max_chars: int
+    section_text: str, title: str, heading: str, max_chars: int, min_chars: int = MIN_CHUNK_CHARS
 ) -> list[str]:
     """Split an oversized section into sub-chunks at paragraph boundaries.
 
     Each sub-chunk is prefixed with the title and heading so the LLM always
-    has context about which section the content belongs to.
+    has context about which section the content belongs to.  A chunk is only
+    closed once it reaches ``min_chars`` (clamped to ``max_chars // 2``);
+    below that the next paragraph is merged in, which may exceed ``max_chars``.
     """
+    min_chars = min(min_chars, max_chars // 2)
     prefix = ""
     if title:
         prefix += title + "\n\n"
     if heading:
         prefix += heading + "\n\n"
 
-    paragraphs = re.split(r"\n{2,}", section_text)
     chunks: list[str] = []
-    current = prefix
+    # Paragraphs of the chunk being built, and its length if emitted as
+    # prefix + paras joined by blank lines — tracked incrementally so the
+    # chunk string is only assembled once instead of re-copied per paragraph.
+    current: list[str] = []
+    current_len = len(prefix)
 
-    for para in paragraphs:
+    for para in _PARAGRAPH_BREAK_RE.split(section_text):
         para = para.strip()
         if not para:
             continue
-        candidate = current + para + "\n\n"
-        if len(candidate) <= max_chars:
-            current = candidate
+        para_len = len(para) + 2  # paragraph plus its "\n\n" separator
+        if current_len + para_len <= max_chars or (current and current_len < min_chars):
+            current.append(para)
+            current_len += para_len
         else:
-            if current.strip() != prefix.strip():
-                chunks.append(current.strip())
-            current = prefix + para + "\n\n"
+            if current:
+                chunks.append((prefix + "\n\n".join(current)).strip())
+            current = [para]
+            current_len = len(prefix) + para_len
 
-    if current.strip() and current.strip() != prefix.strip():
-        chunks.append(current.strip())
+    if current:
+        chunks.append((prefix + "\n\n".join(current)).strip())
 
     return chunks if chunks else [section_text.strip()]
 
 
-def chunk_markdown(text: str, max_chars: int = MAX_CHUNK_CHARS) -> list[dict]:
+def chunk_markdown(
+    text: str, max_chars: int = MAX_CHUNK_CHARS, min_chars: int = MIN_CHUNK_CHARS
+) -> list[dict]:
     """Split a markdown document into heading-aware chunks.
 
     Returns a list of dicts with keys: ``text``, ``section``.
@@ -145,13 +252,146 @@ def chunk_markdown(text: str, max_chars: int = MAX_CHUNK_CHARS) -> list[dict]:
             chunks.append({"text": full_text, "section": section_name})
         else:
             # Section too large — sub-chunk by paragraph
-            sub_chunks = _split_section_by_paragraphs(body, title, heading, max_chars)
+            sub_chunks = _split_section_by_paragraphs(body, title, heading, max_chars, min_chars)
             for sub_text in sub_chunks:
                 chunks.append({"text": sub_text, "section": section_name})
 
     return chunks
 
 
+def _batch_by_budget(texts: list[str], max_items: int, max_chars: int) -> list[list[str]]:
+    """Split ``texts`` in order into batches capped by item count and total length.
+
+    A single text longer than ``max_chars`` is sent in a batch of its own.
+    """
+    batches: list[list[str]] = []
+    current: list[str] = []
+    current_chars = 0
+    for text in texts:
+        if current and (len(current) >= max_items or current_chars + len(text) > max_chars):
+            batches.append(current)
+            current, current_chars = [], 0
+        current.append(text)
+        current_chars += len(text)
+    if current:
+        batches.append(current)
+    return batches
+
+
+async def _embed_all(chunks: list[str], client: AsyncOpenAI, sleep=asyncio.sleep) -> list[list[float]]:
+    """Embed every chunk via concurrent OpenAI requests.
+
+    Chunks are sorted by length before batching so each request carries
+    similarly sized inputs, and sent in batches of at most
+    ``EMBEDDING_BATCH_SIZE`` chunks and ``EMBEDDING_BATCH_MAX_CHARS`` characters,
+    with at most ``EMBEDDING_CONCURRENCY`` requests in flight; a batch that
+    fails transiently is retried on its own, backing off with ``sleep``.
+    Returns one vector per chunk, in the same order as ``chunks``.
+    """
+    sem = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+
+    async def _embed_batch(batch: list[str]) -> list[list[float]]:
+        async with sem:
+            async for attempt in AsyncRetrying(
+                retry=retry_if_exception_type(EMBEDDING_RETRYABLE),
+                stop=stop_after_attempt(EMBEDDING_MAX_ATTEMPTS),
+                wait=wait_random_exponential(multiplier=1.0, max=30.0),
+                sleep=sleep,
+                reraise=True,
+            ):
+                with attempt:
+                    response = await client.embeddings.create(model=EMBEDDING_MODEL, input=batch)
+        return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+
+    order = sorted(range(len(chunks)), key=lambda i: len(chunks[i]))
+    by_length = [chunks[i] for i in order]
+    batches = _batch_by_budget(by_length, EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_MAX_CHARS)
+    results = await asyncio.gather(*(_embed_batch(batch) for batch in batches))
+
+    # Scatter the length-sorted vectors back to their original positions
+    embeddings: list[list[float]] = [[] for _ in chunks]
+    for pos, vec in zip(order, (vec for batch in results for vec in batch)):
+        embeddings[pos] = vec
+    return embeddings
+
+
+async def _embed_with_new_client(chunks: list[str], api_key: str) -> list[list[float]]:
+    """Run ``_embed_all`` with a short-lived AsyncOpenAI client.
+
+    SDK retries are disabled: ``_embed_all`` retries each batch itself, and
+    stacking the two would multiply attempts and backoff.
+    """
+    async with AsyncOpenAI(api_key=api_key, max_retries=0) as client:
+        return await _embed_all(chunks, client)
+
+
+def _chunk_id(relative_path: str, text: str) -> str:
+    """Return the content-addressed Chroma ID for a chunk: ``<relative_path>::<16 hex>``.
+
+    The blake2b digest covers the path and chunk text, so an unchanged chunk
+    keeps its ID across ingests.  The ``<path>::`` prefix is kept because
+    eval.py and the UI read the source file from it.
+    """
+    digest = hashlib.blake2b(f"{relative_path}\0{text}".encode("utf-8"), digest_size=8).hexdigest()
+    return f"{relative_path}::{digest}"
+
+
+def _chunk_hash(text: str) -> str:
+    """Return the sha256 hex digest used as the embedding cache key for a chunk."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _open_embedding_cache(path: Path) -> sqlite3.Connection:
+    """Open (creating if needed) the on-disk ``(model, hash) -> vector`` cache."""
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS emb ("
+        "model TEXT NOT NULL, hash TEXT NOT NULL, vec BLOB NOT NULL, "
+        "PRIMARY KEY (model, hash))"
+    )
+    return conn
+
+
+def _embed_with_cache(chunks: list[str], api_key: str, cache_path: Path) -> list[np.ndarray]:
+    """Return one embedding per chunk, only sending cache misses to OpenAI.
+
+    Vectors are stored as float32 blobs keyed by ``(EMBEDDING_MODEL,
+    sha256(chunk))``, so re-running ingest over unchanged docs makes no
+    embedding requests at all.
+    """
+    hashes = [_chunk_hash(chunk) for chunk in chunks]
+    conn = _open_embedding_cache(cache_path)
+    try:
+        vectors: dict[str, np.ndarray] = {}
+        for h in dict.fromkeys(hashes):
+            row = conn.execute(
+                "SELECT vec FROM emb WHERE model = ? AND hash = ?", (EMBEDDING_MODEL, h)
+            ).fetchone()
+            if row is not None:
+                vectors[h] = np.frombuffer(row[0], dtype=np.float32)
+
+        # Deduplicate misses so identical chunks are only embedded once
+        misses = {h: chunk for h, chunk in zip(hashes, chunks) if h not in vectors}
+        logger.info(
+            "embedding_cache_lookup",
+            extra={"cache_hits": len(vectors), "cache_misses": len(misses)},
+        )
+
+        if misses:
+            fresh = asyncio.run(_embed_with_new_client(list(misses.values()), api_key))
+            rows = []
+            for h, vec in zip(misses, fresh):
+                arr = np.asarray(vec, dtype=np.float32)
+                vectors[h] = arr
+                rows.append((EMBEDDING_MODEL, h, arr.tobytes()))
+            conn.executemany("INSERT OR REPLACE INTO emb (model, hash, vec) VALUES (?, ?, ?)", rows)
+            conn.commit()
+    finally:
+        conn.close()
+
+    return [vectors[h] for h in hashes]
+
+
 def ingest():
     """Main ingestion pipeline.
 
@@ -177,11 +417,18 @@ def ingest():
     all_chunks: list[str] = []
     all_metadatas: list[dict] = []
 
+    seen_ids: set[str] = set()
+
     for doc in documents:
         chunks = chunk_markdown(doc["content"])
         logger.info("doc_chunked", extra={"relative_path": doc["relative_path"], "num_chunks": len(chunks)})
         for i, chunk in enumerate(chunks):
-            all_ids.append(f"{doc['relative_path']}::chunk{i}")
+            chunk_id = _chunk_id(doc["relative_path"], chunk["text"])
+            # Identical chunks in one file share an ID; keep the first only
+            if chunk_id in seen_ids:
+                continue
+            seen_ids.add(chunk_id)
+            all_ids.append(chunk_id)
             all_chunks.append(chunk["text"])
             all_metadatas.append({
                 "source": doc["relative_path"],
@@ -198,6 +445,13 @@ def ingest():
         logger.error("OPENAI_API_KEY environment variable is not set")
         sys.exit(1)
 
+    # Pre-embed everything (cache misses only); Chroma skips its embedding
+    # function when vectors are supplied, so each chunk is only sent to OpenAI once.
+    all_embeddings = _embed_with_cache(all_chunks, api_key, EMBEDDING_CACHE_PATH)
+    logger.info("ingest_embeddings_complete", extra={"total_embeddings": len(all_embeddings)})
+
+    # The collection keeps the OpenAI embedding function so its persisted
+    # configuration matches the one main.py opens it with.
     embedding_fn = OpenAIEmbeddingFunction(
         api_key=api_key,
         model_name=EMBEDDING_MODEL,
@@ -213,15 +467,19 @@ def ingest():
     collection = client.get_or_create_collection(
         name=COLLECTION_NAME,
         embedding_function=embedding_fn,
+        metadata=HNSW_METADATA,
     )
 
-    # Upsert in batches of 100 (Chroma's recommended batch size)
-    batch_size = 100
+    # Upsert in batches (default 250, the top of Chroma's recommended 100-250
+    # range); each batch is one storage transaction, so fewer batches means
+    # fewer commits.
+    batch_size = min(UPSERT_BATCH_SIZE, client.get_max_batch_size())
     for i in range(0, len(all_chunks), batch_size):
         end = min(i + batch_size, len(all_chunks))
         collection.upsert(
             ids=all_ids[i:end],
             documents=all_chunks[i:end],
+            embeddings=all_embeddings[i:end],
             metadatas=all_metadatas[i:end],
         )
 
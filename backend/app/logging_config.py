@@ -5,6 +5,8 @@ import logging
 from contextvars import ContextVar
 from datetime import datetime, timezone
 
+import orjson
+
 # Async-safe ambient request ID — set by logging_middleware per request.
 # Defaults to "-" when accessed outside a request context (e.g. ingest script).
 request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
@@ -23,6 +25,9 @@ _LOGRECORD_ATTRS = frozenset({
 # log corruption.
 _RESERVED_KEYS = frozenset({"timestamp", "level", "logger", "message", "request_id", "exc_info"})
 
+# Union of the above, so format() does a single membership test per attribute.
+_SKIP_KEYS = _LOGRECORD_ATTRS | _RESERVED_KEYS
+
 
 class JsonFormatter(logging.Formatter):
     """Emit each log record as a single-line JSON object.
@@ -41,7 +46,9 @@ class JsonFormatter(logging.Formatter):
 
     def format(self, record: logging.LogRecord) -> str:
         payload: dict = {
-            "timestamp": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            # orjson serializes datetimes natively (same ISO-8601 output as
+            # .isoformat()), so there is no intermediate string to build.
+            "timestamp": datetime.fromtimestamp(record.created, tz=timezone.utc),
             "level": record.levelname,
             "logger": record.name,
             "message": record.getMessage(),
@@ -49,13 +56,19 @@ class JsonFormatter(logging.Formatter):
         }
 
         for key, value in record.__dict__.items():
-            if key not in _LOGRECORD_ATTRS and not key.startswith("_") and key not in _RESERVED_KEYS:
+            if key not in _SKIP_KEYS and not key.startswith("_"):
                 payload[key] = value
 
         if record.exc_info:
             payload["exc_info"] = self.formatException(record.exc_info)
 
-        return json.dumps(payload, default=str)
+        try:
+            return orjson.dumps(payload, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+        except orjson.JSONEncodeError:
+            # orjson rejects ints wider than 64 bits without consulting
+            # ``default``; the stdlib encoder handles them.
+            payload["timestamp"] = payload["timestamp"].isoformat()
+            return json.dumps(payload, default=str, separators=(",", ":"))
 
 
 def setup_logging(level: int = logging.INFO) -> None:
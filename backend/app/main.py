@@ -7,12 +7,14 @@ for embeddings and completions.
 """
 
 import asyncio
-import json
+import hashlib
 import logging
 import os
-import random
+import threading
 import time
 import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import AsyncGenerator
 
@@ -30,14 +32,18 @@ setup_logging()
 logger = logging.getLogger(__name__)
 
 import chromadb
+import httpx
+import numpy as np
+import orjson
 from chromadb.utils.embedding_functions import OpenAIEmbeddingFunction
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from openai import (
     APIConnectionError,
     APITimeoutError,
     AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
     InternalServerError,
     OpenAI,
     RateLimitError,
@@ -46,13 +52,62 @@ from pydantic import BaseModel, Field
 from slowapi import Limiter
 from slowapi.errors import RateLimitExceeded
 from slowapi.util import get_remote_address
+from tenacity import (
+    AsyncRetrying,
+    RetryCallState,
+    Retrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from .cors import StaticCORSMiddleware
 
 CHROMA_DIR = Path(__file__).resolve().parent.parent / "chroma_db"
 DOCS_DIR = Path(__file__).resolve().parent.parent / "docs"
+# Resolved once so get_doc's containment check is a string prefix test
+_DOCS_ROOT = DOCS_DIR.resolve()
+_DOCS_ROOT_PREFIX = str(_DOCS_ROOT) + os.sep
 COLLECTION_NAME = "internal_docs"
+# HNSW index settings — must match HNSW_METADATA in ingest.py, which recreates
+# the collection (test_hnsw_metadata_matches_ingest checks this).  Only
+# applied here if the server creates the collection first.
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 24,
+    "hnsw:construction_ef": 128,
+    "hnsw:search_ef": 100,
+}
 EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "text-embedding-3-small")
 COMPLETION_MODEL = os.environ.get("COMPLETION_MODEL", "gpt-4o-mini")
 
+# Number of distinct (model, query) embeddings kept in memory, and how long
+# each stays valid before the query is re-embedded
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+_cache_ttl_raw = os.environ.get("QUERY_EMBEDDING_CACHE_TTL_S", "86400")
+try:
+    QUERY_EMBEDDING_CACHE_TTL_S = float(_cache_ttl_raw)
+    if QUERY_EMBEDDING_CACHE_TTL_S <= 0:
+        logger.warning(
+            "QUERY_EMBEDDING_CACHE_TTL_S must be positive; got %r. Falling back to default 86400.",
+            _cache_ttl_raw,
+        )
+        QUERY_EMBEDDING_CACHE_TTL_S = 86400.0
+except (TypeError, ValueError):
+    logger.warning(
+        "Invalid QUERY_EMBEDDING_CACHE_TTL_S value %r. Falling back to default 86400.",
+        _cache_ttl_raw,
+    )
+    QUERY_EMBEDDING_CACHE_TTL_S = 86400.0
+
+# Concurrent query-embedding misses are coalesced into one embeddings.create
+# call: a batch is sent after this window or once it reaches the max size
+EMBEDDING_BATCH_WINDOW_S = 0.010
+EMBEDDING_BATCH_MAX_SIZE = 64
+
+# How long a collection.count() result is reused before re-checking Chroma
+COLLECTION_COUNT_TTL_S = 30.0
+
 # Retry configuration for transient OpenAI errors (rate limits, timeouts, etc.)
 OPENAI_RETRYABLE = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
 OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "3"))
@@ -72,7 +127,49 @@ except (TypeError, ValueError):
     )
     OPENAI_RETRY_BASE_DELAY = 1.0
 
-app = FastAPI()
+
+def _warm_up_index() -> None:
+    """Run one throwaway nearest-neighbour search so the HNSW index is loaded.
+
+    Uses a stored vector as the query, so warming up never calls OpenAI.
+    Failures are logged and ignored: a cold first query beats a failed boot.
+    """
+    t0 = time.perf_counter()
+    try:
+        embeddings = collection.peek(1)["embeddings"]
+        if embeddings is None or len(embeddings) == 0:
+            return
+        collection.query(query_embeddings=[embeddings[0]], n_results=1, include=[])
+    except Exception as exc:
+        logger.warning("index_warmup_failed", extra={"error": str(exc)})
+        return
+    logger.info("index_warmup_complete", extra={"warmup_ms": round((time.perf_counter() - t0) * 1000)})
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Startup: prime the collection-count cache and warm the HNSW index.
+
+    Both run before the first request is accepted, so no request pays for a
+    cold ``count()`` or a cold index load.  Either failing is logged and the
+    app starts anyway.  Shutdown closes the OpenAI clients' connection pools.
+    """
+    try:
+        count = await asyncio.to_thread(_collection_count)
+    except Exception as exc:
+        # Boot anyway; the count cache stays cold and requests retry the count
+        logger.warning("startup_collection_count_failed", extra={"error": str(exc)})
+        count = 0
+    else:
+        logger.info("startup_collection_count", extra={"count": count})
+    if count:
+        await asyncio.to_thread(_warm_up_index)
+    yield
+    await async_openai_client.close()
+    openai_client.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 limiter = Limiter(key_func=get_remote_address)
 app.state.limiter = limiter
@@ -86,7 +183,7 @@ async def rate_limit_handler(request: Request, exc: RateLimitExceeded):
 CORS_ORIGINS = [o.strip() for o in os.environ.get("CORS_ORIGINS", "http://localhost:5173").split(",")]
 
 app.add_middleware(
-    CORSMiddleware,
+    StaticCORSMiddleware,
     allow_origins=CORS_ORIGINS,
     allow_methods=["GET", "POST"],
     allow_headers=["Content-Type"],
@@ -96,7 +193,7 @@ app.add_middleware(
 @app.middleware("http")
 async def logging_middleware(request: Request, call_next):
     """Assign a request ID and log request start/end with total latency."""
-    req_id = str(uuid.uuid4())
+    req_id = uuid.uuid4().hex
     token = request_id_var.set(req_id)
     t0 = time.perf_counter()
     logger.info(
@@ -137,53 +234,357 @@ embedding_fn = OpenAIEmbeddingFunction(
     model_name=EMBEDDING_MODEL,
 )
 
-openai_client = OpenAI(api_key=api_key, timeout=30.0, max_retries=0)
-async_openai_client = AsyncOpenAI(api_key=api_key, timeout=30.0, max_retries=0)
+# One keep-alive pool per client, shared by every request in the process.
+# Pool sizes are the SDK defaults; idle connections are kept for 30 s instead
+# of httpx's 5 s, so repeat calls reuse warm TLS connections to api.openai.com.
+_OPENAI_HTTP_LIMITS = httpx.Limits(max_connections=1000, max_keepalive_connections=100, keepalive_expiry=30.0)
+openai_client = OpenAI(
+    api_key=api_key,
+    timeout=30.0,
+    max_retries=0,
+    http_client=DefaultHttpxClient(limits=_OPENAI_HTTP_LIMITS),
+)
+async_openai_client = AsyncOpenAI(
+    api_key=api_key,
+    timeout=30.0,
+    max_retries=0,
+    http_client=DefaultAsyncHttpxClient(limits=_OPENAI_HTTP_LIMITS),
+)
 
 chroma_client = chromadb.PersistentClient(path=str(CHROMA_DIR))
 collection = chroma_client.get_or_create_collection(
     name=COLLECTION_NAME,
     embedding_function=embedding_fn,
+    metadata=HNSW_METADATA,
 )
 
 
-def _openai_call_with_retry(fn):
+def _hnsw_metadata_mismatch(col) -> dict:
+    """Return ``{key: (stored, expected)}`` for HNSW settings that differ from HNSW_METADATA."""
+    stored = col.metadata or {}
+    return {
+        key: (stored.get(key), expected)
+        for key, expected in HNSW_METADATA.items()
+        if stored.get(key) != expected
+    }
+
+
+# get_or_create_collection ignores metadata for an existing collection, so an
+# index built with older settings keeps them until ingest recreates it.
+_hnsw_mismatch = _hnsw_metadata_mismatch(collection)
+if _hnsw_mismatch:
+    logger.warning(
+        "hnsw_metadata_mismatch",
+        extra={
+            "collection": COLLECTION_NAME,
+            "mismatch": {k: {"stored": v[0], "expected": v[1]} for k, v in _hnsw_mismatch.items()},
+            "fix": "re-run python -m app.ingest to rebuild the collection",
+        },
+    )
+
+
+def _log_retry(retry_state: RetryCallState) -> None:
+    """tenacity ``before_sleep`` hook: emit the ``openai_retry`` warning."""
+    logger.warning(
+        "openai_retry",
+        extra={
+            "attempt": retry_state.attempt_number,
+            "max_attempts": max(1, OPENAI_MAX_RETRIES),
+            "delay_s": round(retry_state.next_action.sleep, 2),
+            "error": str(retry_state.outcome.exception()),
+        },
+    )
+
+
+def _retry_policy() -> dict:
+    """tenacity arguments shared by the sync and async OpenAI retry wrappers.
+
+    Built per call so changes to the retry settings (e.g. patched in tests)
+    take effect immediately.  Waits are jittered exponential backoff starting
+    at ``OPENAI_RETRY_BASE_DELAY`` and capped at 30 s; the last error is
+    re-raised once attempts run out.
+    """
+    return {
+        "retry": retry_if_exception_type(OPENAI_RETRYABLE),
+        "wait": wait_random_exponential(multiplier=OPENAI_RETRY_BASE_DELAY, max=30),
+        "stop": stop_after_attempt(max(1, OPENAI_MAX_RETRIES)),
+        "before_sleep": _log_retry,
+        "reraise": True,
+    }
+
+
+class Clock:
+    """The sleep functions the OpenAI retry helpers back off with.
+
+    Pass one to ``_openai_call_with_retry`` / ``_async_openai_call_with_retry``
+    to change how backoff waits (e.g. no-ops in tests) without patching
+    ``time.sleep`` / ``asyncio.sleep`` for every library in the process.
+    Calls without one use ``_default_clock``, looked up at call time.
+    """
+
+    __slots__ = ("sleep", "async_sleep")
+
+    def __init__(self, sleep=time.sleep, async_sleep=asyncio.sleep) -> None:
+        self.sleep = sleep
+        self.async_sleep = async_sleep
+
+
+_default_clock = Clock()
+
+
+def _openai_call_with_retry(fn, clock: Clock | None = None):
     """Call fn() with exponential backoff on transient OpenAI errors (sync)."""
-    max_attempts = max(1, OPENAI_MAX_RETRIES)
-    for attempt in range(1, max_attempts + 1):
-        try:
-            return fn()
-        except OPENAI_RETRYABLE as e:
-            if attempt == max_attempts:
-                raise
-            delay = OPENAI_RETRY_BASE_DELAY * (2 ** (attempt - 1)) + random.uniform(0, 0.5)
-            logger.warning(
-                "openai_retry",
-                extra={"attempt": attempt, "max_attempts": max_attempts, "delay_s": round(delay, 2), "error": str(e)},
-            )
-            time.sleep(delay)
+    clock = clock or _default_clock
+    return Retrying(sleep=clock.sleep, **_retry_policy())(fn)
 
 
-async def _async_openai_call_with_retry(coro_fn):
+async def _async_openai_call_with_retry(coro_fn, clock: Clock | None = None):
     """Call coro_fn() with exponential backoff on transient OpenAI errors (async)."""
-    max_attempts = max(1, OPENAI_MAX_RETRIES)
-    for attempt in range(1, max_attempts + 1):
-        try:
+    clock = clock or _default_clock
+    async for attempt in AsyncRetrying(sleep=clock.async_sleep, **_retry_policy()):
+        with attempt:
             return await coro_fn()
-        except OPENAI_RETRYABLE as e:
-            if attempt == max_attempts:
-                raise
-            delay = OPENAI_RETRY_BASE_DELAY * (2 ** (attempt - 1)) + random.uniform(0, 0.5)
-            logger.warning(
-                "openai_retry",
-                extra={"attempt": attempt, "max_attempts": max_attempts, "delay_s": round(delay, 2), "error": str(e)},
-            )
-            await asyncio.sleep(delay)
+
+
+class QueryEmbeddingCache:
+    """Thread-safe, TTL-bounded LRU of query embeddings.
+
+    Entries are content-addressed by a blake2b digest of ``model:query`` and
+    hold the vector as raw float32 bytes (~6 KB for 1536 dims, versus ~50 KB
+    as a list of Python floats).  Shared by the sync and async embedding
+    paths, so a query embedded for one endpoint is a hit for every other.
+    """
+
+    def __init__(self, maxsize: int, ttl_s: float) -> None:
+        self._maxsize = maxsize
+        self._ttl_s = ttl_s
+        self._data: OrderedDict[bytes, tuple[float, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(model: str, query: str) -> bytes:
+        return hashlib.blake2b(f"{model}:{query}".encode(), digest_size=16).digest()
+
+    def get(self, model: str, query: str) -> np.ndarray | None:
+        """Return the cached (read-only) vector, or None on a miss or expired entry."""
+        key = self._key(model, query)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, raw = entry
+            if time.monotonic() >= expires_at:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+        return np.frombuffer(raw, dtype=np.float32)
+
+    def put(self, model: str, query: str, vec) -> np.ndarray:
+        """Store ``vec`` as float32 and return the cached array."""
+        raw = np.asarray(vec, dtype=np.float32).tobytes()
+        key = self._key(model, query)
+        with self._lock:
+            self._data[key] = (time.monotonic() + self._ttl_s, raw)
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+        return np.frombuffer(raw, dtype=np.float32)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+_query_embeddings = QueryEmbeddingCache(QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_TTL_S)
+
+
+def _embed_query(model: str, query: str) -> np.ndarray:
+    """Embed a query string via the sync OpenAI client, cached per ``(model, query)``."""
+    vec = _query_embeddings.get(model, query)
+    if vec is None:
+        response = _openai_call_with_retry(
+            lambda: openai_client.embeddings.create(model=model, input=[query])
+        )
+        vec = _query_embeddings.put(model, query, response.data[0].embedding)
+    return vec
+
+
+class EmbeddingBatcher:
+    """Coalesce concurrent single-query embeddings into one OpenAI call.
+
+    The first request to arrive arms a ``window_s`` timer on the running loop;
+    every request queued before it fires (or until ``max_size`` is reached) is
+    sent as a single ``embeddings.create(input=[...])`` and each caller's
+    future is resolved with its own vector.  No background task outlives a
+    batch, so the batcher works under any event loop, including the
+    per-request loops of a bare TestClient.
+    """
+
+    def __init__(self, window_s: float, max_size: int) -> None:
+        self._window_s = window_s
+        self._max_size = max_size
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._pending: list[tuple[str, str, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def embed(self, model: str, text: str) -> list[float]:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._rebind(loop)
+        future = loop.create_future()
+        self._pending.append((model, text, future))
+        if len(self._pending) >= self._max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._window_s, self._flush)
+        return await future
+
+    def _rebind(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Switch to ``loop``, dropping the previous loop's timer and waiters.
+
+        The stale timer is cancelled and any callers still queued on the old
+        loop are failed, from that loop's own thread, so none of them hangs.
+        A closed old loop has nothing left to resume.
+        """
+        old_loop, timer, stale = self._loop, self._timer, self._pending
+        self._loop, self._pending, self._timer = loop, [], None
+        if old_loop is None or old_loop.is_closed() or (timer is None and not stale):
+            return
+
+        def fail_stale() -> None:
+            if timer is not None:
+                timer.cancel()
+            exc = RuntimeError("event loop changed before the embedding batch was sent")
+            for _, _, future in stale:
+                if not future.done():
+                    future.set_exception(exc)
+
+        old_loop.call_soon_threadsafe(fail_stale)
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = self._loop.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _send(batch: list[tuple[str, str, asyncio.Future]]) -> None:
+        # Group by model and dedupe identical texts within the batch.
+        by_model: dict[str, dict[str, list[asyncio.Future]]] = {}
+        for model, text, future in batch:
+            by_model.setdefault(model, {}).setdefault(text, []).append(future)
+
+        for model, waiters in by_model.items():
+            texts = list(waiters)
+            try:
+                response = await _async_openai_call_with_retry(
+                    lambda model=model, texts=texts: async_openai_client.embeddings.create(
+                        model=model, input=texts
+                    )
+                )
+                data = response.data
+                if len(data) != len(texts):
+                    raise RuntimeError(
+                        f"embeddings.create returned {len(data)} vectors for {len(texts)} inputs"
+                    )
+                if len(data) > 1:
+                    data = sorted(data, key=lambda d: d.index)
+                for futures, item in zip(waiters.values(), data):
+                    for future in futures:
+                        if not future.done():
+                            future.set_result(item.embedding)
+            except Exception as exc:
+                # Fail every caller still waiting, so no request hangs on its future
+                for futures in waiters.values():
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(exc)
+
+
+_embedding_batcher = EmbeddingBatcher(EMBEDDING_BATCH_WINDOW_S, EMBEDDING_BATCH_MAX_SIZE)
+
+
+async def _aembed_query(model: str, query: str) -> np.ndarray:
+    """Embed a query string via the async OpenAI client, cached per ``(model, query)``.
+
+    Misses go through ``_embedding_batcher``, so N concurrent new queries cost
+    one embeddings round-trip instead of N.
+    """
+    vec = _query_embeddings.get(model, query)
+    if vec is None:
+        embedding = await _embedding_batcher.embed(model, query)
+        vec = _query_embeddings.put(model, query, embedding)
+    return vec
+
+
+# Cached collection.count() result and the monotonic time it was taken
+_count_cache: dict = {"n": None, "t": 0.0}
+
+
+def _count_is_fresh() -> bool:
+    """True if ``_count_cache`` holds a count younger than ``COLLECTION_COUNT_TTL_S``."""
+    return _count_cache["n"] is not None and time.monotonic() - _count_cache["t"] <= COLLECTION_COUNT_TTL_S
+
+
+def _collection_count() -> int:
+    """Return ``collection.count()``, reusing the last result for ``COLLECTION_COUNT_TTL_S``."""
+    if not _count_is_fresh():
+        _count_cache["n"] = collection.count()
+        _count_cache["t"] = time.monotonic()
+    return _count_cache["n"]
+
+
+async def _acollection_count() -> int:
+    """Async ``_collection_count``; only a stale cache pays for a worker-thread hop."""
+    if _count_is_fresh():
+        return _count_cache["n"]
+    return await asyncio.to_thread(_collection_count)
+
+
+def _vector_search(query: str, n_results: int, **kwargs) -> dict:
+    """Embed ``query`` (cached) and return its ``n_results`` nearest chunks (blocking)."""
+    return collection.query(
+        query_embeddings=[_embed_query(EMBEDDING_MODEL, query)],
+        n_results=n_results,
+        **kwargs,
+    )
+
+
+def _similarity_scores(results: dict) -> list[float]:
+    """Convert the top query's cosine distances into similarity scores.
+
+    One vectorised pass for the whole result set.  Scores are not rounded
+    server-side; clients format them for display.
+    """
+    return (1.0 - np.asarray(results["distances"][0], dtype=np.float64)).tolist()
+
+
+async def _avector_search(query: str, n_results: int, **kwargs) -> dict:
+    """Async ``_vector_search``.
+
+    The embedding is awaited on the event loop; only the Chroma search (a
+    blocking SQLite + HNSW call) is pushed to a worker thread.
+    """
+    embedding = await _aembed_query(EMBEDDING_MODEL, query)
+    return await asyncio.to_thread(
+        collection.query,
+        query_embeddings=[embedding],
+        n_results=n_results,
+        **kwargs,
+    )
 
 
 class RetrieveRequest(BaseModel):
     query: str
     top_k: int = Field(default=5, ge=1, le=20)
+    # False returns only doc_id + score (text=""), for clients that already
+    # hold the chunk text
+    include_text: bool = True
 
 
 class ChunkResult(BaseModel):
@@ -202,44 +603,43 @@ def health():
     return {"status": "ok"}
 
 
-@app.post("/retrieve", response_model=RetrieveResponse)
+# The response is built as plain dicts and serialized with orjson, skipping
+# Pydantic validation of every ChunkResult; RetrieveResponse still documents
+# the schema in OpenAPI.
+@app.post("/retrieve", response_model=None, responses={200: {"model": RetrieveResponse}})
 @limiter.limit("30/minute")
-def retrieve(req: RetrieveRequest, request: Request):
+async def retrieve(req: RetrieveRequest, request: Request):
     """Return the top-k most similar chunks for a query (retrieval only, no LLM)."""
     logger.info("retrieve_request", extra={"query": req.query, "top_k": req.top_k})
 
-    if collection.count() == 0:
+    count = await _acollection_count()
+    if count == 0:
         logger.warning("retrieve_no_docs")
         raise HTTPException(status_code=503, detail="No documents ingested yet. Run: python -m app.ingest")
 
     t0 = time.perf_counter()
-    results = collection.query(
-        query_texts=[req.query],
-        n_results=min(req.top_k, collection.count()),
-    )
+    # /retrieve never reads metadata, so don't ship it back from Chroma
+    include = ["documents", "distances"] if req.include_text else ["distances"]
+    results = await _avector_search(req.query, min(req.top_k, count), include=include)
     retrieval_ms = round((time.perf_counter() - t0) * 1000)
 
-    chunks = []
-    for doc_id, distance, text in zip(
-        results["ids"][0],
-        results["distances"][0],
-        results["documents"][0],
-    ):
-        chunks.append(ChunkResult(
-            doc_id=doc_id,
-            score=round(1 - distance, 4),  # Chroma returns distance; convert to similarity
-            text=text,
-        ))
+    # Chroma returns distance; convert to similarity
+    ids = results["ids"][0]
+    texts = results["documents"][0] if req.include_text else [""] * len(ids)
+    chunks = [
+        {"doc_id": doc_id, "score": score, "text": text}
+        for doc_id, score, text in zip(ids, _similarity_scores(results), texts)
+    ]
 
     logger.info(
         "retrieval_complete",
         extra={
             "num_results": len(chunks),
-            "top_score": chunks[0].score if chunks else None,
+            "top_score": chunks[0]["score"] if chunks else None,
             "latency_ms": retrieval_ms,
         },
     )
-    return RetrieveResponse(results=chunks)
+    return ORJSONResponse({"results": chunks})
 
 
 SYSTEM_PROMPT = """You are an internal documentation assistant. Answer the user's question using ONLY the provided context below. Do not use any prior knowledge.
@@ -251,6 +651,9 @@ Be concise and direct. Cite the source document when possible.
 Context:
 {context}"""
 
+# Split once at import so requests concatenate strings instead of re-parsing the template
+_SYSTEM_PROMPT_PREFIX, _SYSTEM_PROMPT_SUFFIX = SYSTEM_PROMPT.split("{context}")
+
 
 class QueryRequest(BaseModel):
     query: str
@@ -265,37 +668,42 @@ class QueryResponse(BaseModel):
 
 @app.post("/query", response_model=QueryResponse)
 @limiter.limit("10/minute")
-def query(req: QueryRequest, request: Request):
+async def query(req: QueryRequest, request: Request):
     """Retrieve relevant chunks and generate an LLM answer grounded in them."""
     logger.info("query_request", extra={"query": req.query, "top_k": req.top_k})
 
-    if collection.count() == 0:
+    count = await _acollection_count()
+    if count == 0:
         logger.warning("query_no_docs")
         raise HTTPException(status_code=503, detail="No documents ingested yet. Run: python -m app.ingest")
 
     t0 = time.perf_counter()
-    results = collection.query(
-        query_texts=[req.query],
-        n_results=min(req.top_k, collection.count()),
+    results = await _avector_search(
+        req.query,
+        min(req.top_k, count),
+        include=["documents", "distances", "metadatas"],
     )
     retrieval_ms = round((time.perf_counter() - t0) * 1000)
 
     # Build context and chunk results from retrieved chunks
     context_parts = []
     sources = []
+    seen_sources = set()
     chunks = []
-    for doc_id, distance, text in zip(
+    for doc_id, score, text, meta in zip(
         results["ids"][0],
-        results["distances"][0],
+        _similarity_scores(results),
         results["documents"][0],
+        results["metadatas"][0],
     ):
-        source = doc_id.split("::")[0]
+        source = meta["source"]  # stored at ingest time; no need to parse doc_id
         context_parts.append(f"[Source: {source}]\n{text}")
-        if source not in sources:
+        if source not in seen_sources:
+            seen_sources.add(source)
             sources.append(source)
         chunks.append(ChunkResult(
             doc_id=doc_id,
-            score=round(1 - distance, 4),
+            score=score,
             text=text,
         ))
 
@@ -313,12 +721,12 @@ def query(req: QueryRequest, request: Request):
 
     try:
         t1 = time.perf_counter()
-        completion = _openai_call_with_retry(
-            lambda: openai_client.chat.completions.create(
+        completion = await _async_openai_call_with_retry(
+            lambda: async_openai_client.chat.completions.create(
                 model=COMPLETION_MODEL,
                 temperature=0.1,
                 messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT.format(context=context)},
+                    {"role": "system", "content": f"{_SYSTEM_PROMPT_PREFIX}{context}{_SYSTEM_PROMPT_SUFFIX}"},
                     {"role": "user", "content": req.query},
                 ],
             )
@@ -343,8 +751,24 @@ def query(req: QueryRequest, request: Request):
     )
 
 
-async def stream_query_response(req: QueryRequest) -> AsyncGenerator[str, None]:
-    """Async generator that yields SSE-formatted strings for /query/stream.
+_SSE_DATA = b"\ndata: "
+_SSE_END = b"\n\n"
+_SSE_DONE = b"event: done\ndata: {}\n\n"
+
+
+def _sse(event: str, data: dict) -> bytes:
+    """Format one Server-Sent Event as UTF-8 bytes.
+
+    Serialized with orjson, which is several times faster than the stdlib
+    for the small payloads this is called with on every LLM output token,
+    and already returns bytes — so StreamingResponse forwards each event
+    without a per-token ``str.encode``.
+    """
+    return b"event: " + event.encode() + _SSE_DATA + orjson.dumps(data) + _SSE_END
+
+
+async def stream_query_response(req: QueryRequest) -> AsyncGenerator[bytes, None]:
+    """Async generator that yields SSE-formatted bytes for /query/stream.
 
     Event sequence:
       metadata — sources + chunks, emitted right after vector search
@@ -352,30 +776,35 @@ async def stream_query_response(req: QueryRequest) -> AsyncGenerator[str, None]:
       done     — signals end of stream
       error    — emitted instead of done if something goes wrong
     """
-    if collection.count() == 0:
+    count = await _acollection_count()
+    if count == 0:
         logger.warning("stream_no_docs")
-        yield f"event: error\ndata: {json.dumps({'detail': 'No documents ingested yet. Run: python -m app.ingest'})}\n\n"
+        yield _sse("error", {"detail": "No documents ingested yet. Run: python -m app.ingest"})
         return
 
     try:
         t0 = time.perf_counter()
-        results = collection.query(
-            query_texts=[req.query],
-            n_results=min(req.top_k, collection.count()),
+        results = await _avector_search(
+            req.query,
+            min(req.top_k, count),
+            include=["documents", "distances", "metadatas"],
         )
         retrieval_ms = round((time.perf_counter() - t0) * 1000)
 
         context_parts, sources, chunks = [], [], []
-        for doc_id, distance, text in zip(
+        seen_sources = set()
+        for doc_id, score, text, meta in zip(
             results["ids"][0],
-            results["distances"][0],
+            _similarity_scores(results),
             results["documents"][0],
+            results["metadatas"][0],
         ):
-            source = doc_id.split("::")[0]
+            source = meta["source"]
             context_parts.append(f"[Source: {source}]\n{text}")
-            if source not in sources:
+            if source not in seen_sources:
+                seen_sources.add(source)
                 sources.append(source)
-            chunks.append(ChunkResult(doc_id=doc_id, score=round(1 - distance, 4), text=text))
+            chunks.append(ChunkResult(doc_id=doc_id, score=score, text=text))
 
         logger.info(
             "stream_retrieval_complete",
@@ -386,12 +815,14 @@ async def stream_query_response(req: QueryRequest) -> AsyncGenerator[str, None]:
                 "latency_ms": retrieval_ms,
             },
         )
-        yield f"event: metadata\ndata: {json.dumps({'sources': sources, 'chunks': [c.model_dump() for c in chunks]})}\n\n"
+        yield _sse("metadata", {"sources": sources, "chunks": [c.model_dump() for c in chunks]})
     except Exception as e:
         logger.error("stream_retrieval_error", extra={"detail": str(e)}, exc_info=True)
-        yield f"event: error\ndata: {json.dumps({'detail': f'Vector search failed: {e}'})}\n\n"
+        yield _sse("error", {"detail": f"Vector search failed: {e}"})
         return
 
+    context = "\n\n---\n\n".join(context_parts)
+
     try:
         t1 = time.perf_counter()
         stream = await _async_openai_call_with_retry(
@@ -400,7 +831,7 @@ async def stream_query_response(req: QueryRequest) -> AsyncGenerator[str, None]:
                 temperature=0.1,
                 stream=True,
                 messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT.format(context="\n\n---\n\n".join(context_parts))},
+                    {"role": "system", "content": f"{_SYSTEM_PROMPT_PREFIX}{context}{_SYSTEM_PROMPT_SUFFIX}"},
                     {"role": "user", "content": req.query},
                 ],
             )
@@ -408,7 +839,7 @@ async def stream_query_response(req: QueryRequest) -> AsyncGenerator[str, None]:
         async for chunk in stream:
             delta = chunk.choices[0].delta
             if delta.content:
-                yield f"event: token\ndata: {json.dumps({'text': delta.content})}\n\n"
+                yield _sse("token", {"text": delta.content})
         llm_ms = round((time.perf_counter() - t1) * 1000)
         logger.info(
             "stream_llm_complete",
@@ -416,10 +847,10 @@ async def stream_query_response(req: QueryRequest) -> AsyncGenerator[str, None]:
         )
     except Exception as e:
         logger.error("stream_llm_error", extra={"detail": str(e)}, exc_info=True)
-        yield f"event: error\ndata: {json.dumps({'detail': f'LLM request failed: {e}'})}\n\n"
+        yield _sse("error", {"detail": f"LLM request failed: {e}"})
         return
 
-    yield "event: done\ndata: {}\n\n"
+    yield _SSE_DONE
 
 
 @app.post("/query/stream")
@@ -447,24 +878,25 @@ class DebugQueryResponse(BaseModel):
 
 
 @app.post("/debug-query", response_model=DebugQueryResponse)
-def debug_query(req: RetrieveRequest):
+def debug_query(req: QueryRequest):
     """Return retrieval diagnostics: doc_id, section, chunk_id, score, first 200 chars."""
     logger.info("debug_query_request", extra={"query": req.query, "top_k": req.top_k})
 
-    if collection.count() == 0:
+    count = _collection_count()
+    if count == 0:
         logger.warning("debug_query_no_docs")
         raise HTTPException(status_code=503, detail="No documents ingested yet. Run: python -m app.ingest")
 
-    results = collection.query(
-        query_texts=[req.query],
-        n_results=min(req.top_k, collection.count()),
+    results = _vector_search(
+        req.query,
+        min(req.top_k, count),
         include=["documents", "distances", "metadatas"],
     )
 
     debug_results = []
-    for doc_id, distance, text, meta in zip(
+    for doc_id, score, text, meta in zip(
         results["ids"][0],
-        results["distances"][0],
+        _similarity_scores(results),
         results["documents"][0],
         results["metadatas"][0],
     ):
@@ -472,18 +904,39 @@ def debug_query(req: RetrieveRequest):
             doc_id=doc_id,
             section=meta.get("section", ""),
             chunk_index=meta.get("chunk_index", -1),
-            score=round(1 - distance, 4),
+            score=score,
             preview=text[:200],
         ))
 
     return DebugQueryResponse(query=req.query, results=debug_results)
 
 
+# Sorted doc filenames, and the DOCS_DIR mtime they were listed at
+_docs_list_cache: dict = {"mtime": None, "names": []}
+
+
+def _get_docs_list() -> list[str]:
+    """Return sorted ``*.md`` filenames in DOCS_DIR, re-globbing only when the directory changes.
+
+    Adding, removing or renaming a file bumps the directory's mtime, so one
+    ``stat()`` per request replaces a full glob + sort.  A missing directory
+    lists no docs.
+    """
+    try:
+        mtime = DOCS_DIR.stat().st_mtime_ns
+    except FileNotFoundError:
+        _docs_list_cache["mtime"] = None
+        return []
+    if mtime != _docs_list_cache["mtime"]:
+        _docs_list_cache["names"] = [f.name for f in sorted(DOCS_DIR.glob("*.md"))]
+        _docs_list_cache["mtime"] = mtime
+    return _docs_list_cache["names"]
+
+
 @app.get("/api/docs")
 def list_docs():
     """Return a list of available documentation filenames."""
-    files = sorted(DOCS_DIR.glob("*.md"))
-    return [f.name for f in files]
+    return _get_docs_list()
 
 
 @app.get("/api/docs/{filename}")
@@ -492,8 +945,8 @@ def get_doc(filename: str):
     if not filename.endswith(".md") or "/" in filename or "\\" in filename or ".." in filename:
         logger.warning("doc_not_found", extra={"doc_filename": filename, "status_code": 404})
         raise HTTPException(status_code=404, detail="Not found")
-    path = (DOCS_DIR / filename).resolve()
-    if not path.is_relative_to(DOCS_DIR.resolve()) or not path.is_file():
+    path = (_DOCS_ROOT / filename).resolve()
+    if not str(path).startswith(_DOCS_ROOT_PREFIX) or not path.is_file():
         logger.warning("doc_not_found", extra={"doc_filename": filename, "status_code": 404})
         raise HTTPException(status_code=404, detail="Not found")
 
@@ -1,29 +1,42 @@
 """Shared pytest fixtures for backend integration tests.
 
 Sets OPENAI_API_KEY before importing the app (required because main.py reads
-it at module level).  Provides a FakeEmbeddingFunction and fixtures for a
+it at module level).  Provides a FakeEmbeddingFunction (also used to embed
+queries in place of OpenAI), a session-wide TestClient, and fixtures for a
 pre-seeded real ChromaDB EphemeralClient collection and an empty one.
 """
 
+import hashlib
 import os
 import uuid
 
 os.environ.setdefault("OPENAI_API_KEY", "test-key")
 
 import chromadb
+import httpx
+import numpy as np
 import pytest
 from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
 from fastapi.testclient import TestClient
-from unittest.mock import patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
-from backend.app.main import app
+from backend.app import main
+from backend.app.ingest import _chunk_id
 
-# Disable rate limiting once for all tests in this process
-app.state.limiter._default_limits = []
+
+@pytest.fixture(scope="session")
+def app():
+    """The FastAPI app, with rate limiting disabled once for the whole session.
+
+    Test modules take the app from this fixture rather than importing it, so
+    setup lives in one place whatever order (or xdist shard) modules load in.
+    """
+    main.app.state.limiter._default_limits = []
+    return main.app
 
 
 @pytest.fixture(autouse=True)
-def reset_rate_limiter():
+def reset_rate_limiter(app):
     """Reset limiter counters before every test.
 
     The integration tests make multiple requests to the same endpoints (e.g.
@@ -34,11 +47,17 @@ def reset_rate_limiter():
     app.state.limiter._storage.reset()
     yield
 
+
+@pytest.fixture(autouse=True)
+def reset_collection_count():
+    """Drop the cached collection.count() so each test sees its own (mocked) collection."""
+    main._count_cache["n"] = None
+    yield
+
 # ---------------------------------------------------------------------------
 # Seed data — shared across integration tests
 # ---------------------------------------------------------------------------
 
-SEED_IDS = ["guide.md::chunk0", "guide.md::chunk1", "faq.md::chunk0"]
 SEED_DOCUMENTS = [
     "## Installation\n\nInstall with pip install mypackage.",
     "## Configuration\n\nSet the API_KEY environment variable.",
@@ -49,6 +68,8 @@ SEED_METADATAS = [
     {"source": "guide.md", "section": "Configuration", "chunk_index": 1},
     {"source": "faq.md", "section": "FAQ", "chunk_index": 0},
 ]
+# IDs built the same way ingest builds them
+SEED_IDS = [_chunk_id(m["source"], doc) for m, doc in zip(SEED_METADATAS, SEED_DOCUMENTS)]
 
 
 # ---------------------------------------------------------------------------
@@ -58,16 +79,26 @@ SEED_METADATAS = [
 class FakeEmbeddingFunction(EmbeddingFunction[Documents]):
     """Deterministic 4-dim embedding function — no OpenAI calls.
 
-    Uses a hash of the document text to produce distinct first components so
-    cosine distances are non-zero and ordering is deterministic for a given
-    PYTHONHASHSEED.  Tests should assert count and schema, not specific ordering.
+    The first component is a blake2b fingerprint of the document text, so
+    cosine distances are non-zero and identical across processes and
+    PYTHONHASHSEED values.  Tests should assert count and schema, not specific
+    ordering.
     """
 
     def __init__(self) -> None:
         pass  # suppress DeprecationWarning from base class __init__
 
     def __call__(self, input: Documents) -> Embeddings:
-        return [[float(hash(doc) % 100) / 100.0, 0.5, 0.5, 0.5] for doc in input]
+        first = np.fromiter(
+            (
+                int.from_bytes(hashlib.blake2b(doc.encode(), digest_size=2).digest(), "little") / 65535
+                for doc in input
+            ),
+            dtype=np.float32,
+            count=len(input),
+        )
+        rest = np.full((len(input), 3), 0.5, dtype=np.float32)
+        return list(np.column_stack([first, rest]))
 
     @staticmethod
     def name() -> str:
@@ -85,49 +116,116 @@ class FakeEmbeddingFunction(EmbeddingFunction[Documents]):
 # Fixtures
 # ---------------------------------------------------------------------------
 
+@pytest.fixture(autouse=True)
+def fake_query_embeddings():
+    """Embed queries with FakeEmbeddingFunction instead of calling OpenAI.
+
+    The endpoints embed queries themselves (via the cached ``_embed_query`` /
+    ``_aembed_query``) and pass ``query_embeddings=`` to Chroma, so every test
+    needs these seams patched — including the mocked-collection unit tests in
+    test_main.py.  Calls through either seam are recorded on the yielded mock.
+    """
+    fake = FakeEmbeddingFunction()
+    mock_embed = MagicMock(side_effect=lambda model, query: fake([query])[0])
+    with patch("backend.app.main._embed_query", mock_embed), patch(
+        "backend.app.main._aembed_query", AsyncMock(side_effect=mock_embed)
+    ):
+        yield mock_embed
+
+
+@pytest.fixture(scope="session")
+def _ephemeral_client():
+    """One in-memory ChromaDB client for the whole session.
+
+    Client construction is the expensive part of these fixtures; collections
+    are cheap, so every collection fixture creates its collection here.
+    """
+    return chromadb.EphemeralClient()
+
+
 @pytest.fixture(scope="session")
-def seeded_collection():
+def seeded_collection(_ephemeral_client):
     """Session-scoped real ChromaDB in-memory collection with 3 test documents.
 
     NOTE: chromadb.EphemeralClient() instances share a single global in-memory
     store in ChromaDB 1.5.0, so isolation is by collection name, not client.
     This collection is read-only during tests — never upsert/delete from it.
+    The seed vectors are computed up front and written in one batched upsert,
+    so Chroma never calls the embedding function during seeding.
     """
-    ec = chromadb.EphemeralClient()
-    col = ec.get_or_create_collection(
+    embedding_function = FakeEmbeddingFunction()
+    col = _ephemeral_client.get_or_create_collection(
         name="integration_seeded",
-        embedding_function=FakeEmbeddingFunction(),
+        embedding_function=embedding_function,
         metadata={"hnsw:space": "cosine"},
     )
-    col.upsert(ids=SEED_IDS, documents=SEED_DOCUMENTS, metadatas=SEED_METADATAS)
+    col.upsert(
+        ids=SEED_IDS,
+        documents=SEED_DOCUMENTS,
+        metadatas=SEED_METADATAS,
+        embeddings=embedding_function(SEED_DOCUMENTS),
+    )
     yield col
 
 
-@pytest.fixture
-def empty_collection():
-    """Function-scoped real ChromaDB in-memory collection with 0 documents.
+@pytest.fixture(scope="session")
+def empty_collection(_ephemeral_client):
+    """Session-scoped real ChromaDB in-memory collection with 0 documents.
 
-    Uses a uuid4 suffix to guarantee a fresh collection name on every call,
-    since all EphemeralClient instances share the same global store.
+    Uses a uuid4 suffix so the name never collides with another collection in
+    the global store shared by all EphemeralClient instances.  Like the seeded
+    collection it is read-only during tests, so one instance serves them all;
+    it is dropped at session end.
     """
-    ec = chromadb.EphemeralClient()
-    col = ec.get_or_create_collection(
+    col = _ephemeral_client.get_or_create_collection(
         name=f"integration_empty_{uuid.uuid4().hex}",
         embedding_function=FakeEmbeddingFunction(),
         metadata={"hnsw:space": "cosine"},
     )
     yield col
+    _ephemeral_client.delete_collection(col.name)
+
+
+@pytest.fixture(scope="session")
+def client(app):
+    """One TestClient for the whole session, so the app lifespan runs once.
+
+    Endpoints resolve ``backend.app.main.collection`` (and the OpenAI clients)
+    per request, so per-test ``patch`` calls still take effect.
+    """
+    with TestClient(app) as c:
+        yield c
 
 
 @pytest.fixture
-def integration_client(seeded_collection):
-    """TestClient with backend.app.main.collection replaced by the seeded collection."""
+def integration_client(client, seeded_collection):
+    """The shared TestClient with backend.app.main.collection replaced by the seeded collection."""
+    with patch("backend.app.main.collection", seeded_collection):
+        yield client
+
+
+@pytest.fixture
+def anyio_backend():
+    """Run ``@pytest.mark.anyio`` tests on asyncio only — the app uses asyncio APIs directly."""
+    return "asyncio"
+
+
+@pytest.fixture
+async def async_integration_client(app, seeded_collection):
+    """httpx.AsyncClient over ASGITransport, with the seeded collection patched in.
+
+    The app runs on the test's own event loop, so async generators such as the
+    SSE stream are driven directly instead of through TestClient's portal
+    thread.  Use from ``@pytest.mark.anyio`` tests.
+    """
+    transport = httpx.ASGITransport(app=app)
     with patch("backend.app.main.collection", seeded_collection):
-        yield TestClient(app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+            yield c
 
 
 @pytest.fixture
-def empty_integration_client(empty_collection):
-    """TestClient with backend.app.main.collection replaced by an empty collection."""
+def empty_integration_client(client, empty_collection):
+    """The shared TestClient with backend.app.main.collection replaced by an empty collection."""
     with patch("backend.app.main.collection", empty_collection):
-        yield TestClient(app)
+        yield client
@@ -0,0 +1,33 @@
+"""Plain stand-ins for OpenAI chat completion and stream-chunk objects.
+
+The app only reads ``.choices[0].message.content`` and
+``.choices[0].delta.content``, so namedtuples replace MagicMock trees.
+"""
+
+from collections import namedtuple
+
+Message = namedtuple("Message", "content")
+Delta = namedtuple("Delta", "content")
+Choice = namedtuple("Choice", "message delta", defaults=(None, None))
+Completion = namedtuple("Completion", "choices")
+Chunk = namedtuple("Chunk", "choices")
+
+
+def make_mock_completion(text: str) -> Completion:
+    """Build a minimal stand-in for async_openai_client.chat.completions.create's return value."""
+    return Completion(choices=(Choice(message=Message(content=text)),))
+
+
+def _stream_chunk(token):
+    """Return a stream chunk whose delta content is ``token``."""
+    return Chunk(choices=(Choice(delta=Delta(content=token)),))
+
+
+def make_async_stream(*tokens: str):
+    """Async generator that yields mock LLM stream chunks, then a content=None terminator."""
+    async def _stream():
+        for token in tokens:
+            yield _stream_chunk(token)
+        yield _stream_chunk(None)
+
+    return _stream()
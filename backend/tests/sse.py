@@ -0,0 +1,82 @@
+"""Server-Sent Events parsing helpers shared by the /query/stream tests."""
+
+import json
+import re
+
+
+def _decode_data(raw: str):
+    """JSON-decode an event's data, falling back to the raw string."""
+    try:
+        return json.loads(raw)
+    except json.JSONDecodeError:
+        return raw
+
+
+def _apply_sse_line(event: dict, line: str, decode_data: bool = True) -> None:
+    """Record an ``event:`` or ``data:`` line (data JSON-decoded when possible) on ``event``."""
+    field = line[:6]
+    if field == "event:":
+        event["event"] = line[6:].strip()
+    elif field[:5] == "data:":
+        raw = line[5:].strip()
+        event["data"] = _decode_data(raw) if decode_data else raw
+
+
+# One SSE event as the server frames it: optional "event:" line, one "data:"
+# line, blank-line terminator
+_SSE_RE = re.compile(r"(?:event:[ \t]*(?P<event>[^\n]*)\n)?data:[ \t]*(?P<data>[^\n]*)\n\n")
+
+
+def parse_sse_events(text: str, *, decode_data: bool = True) -> list[dict]:
+    """Parse a raw SSE response body into a list of {event, data} dicts.
+
+    With ``decode_data=False`` each ``data`` is left as the raw string, for
+    tests that only check which events arrived and in what order.
+    """
+    events = []
+    for m in _SSE_RE.finditer(text):
+        event: dict = {}
+        if m["event"] is not None:
+            event["event"] = m["event"].strip()
+        raw = m["data"].strip()
+        event["data"] = _decode_data(raw) if decode_data else raw
+        events.append(event)
+    return events
+
+
+async def aiter_sse_events(response, *, decode_data: bool = True):
+    """Async ``iter_sse_events`` for an ``httpx.AsyncClient`` streamed response."""
+    current: dict = {}
+    async for line in response.aiter_lines():
+        if line:
+            _apply_sse_line(current, line, decode_data)
+        elif current:
+            yield current
+            current = {}
+    if current:
+        yield current
+
+
+def index_events(events: list[dict]) -> dict[str, list[dict]]:
+    """Group events by type in one pass, preserving order within each type."""
+    index: dict[str, list[dict]] = {}
+    for event in events:
+        index.setdefault(event["event"], []).append(event)
+    return index
+
+
+def iter_sse_events(response, *, decode_data: bool = True):
+    """Yield {event, data} dicts from a streamed response as each event completes.
+
+    Lets a test stop reading once it has seen the event it asserts on,
+    instead of buffering the whole body through ``res.text``.
+    """
+    current: dict = {}
+    for line in response.iter_lines():
+        if line:
+            _apply_sse_line(current, line, decode_data)
+        elif current:
+            yield current
+            current = {}
+    if current:
+        yield current
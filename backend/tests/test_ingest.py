@@ -1,11 +1,20 @@
 """Unit tests for the pure chunking and loading functions in backend.app.ingest."""
 
+import asyncio
 from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
 
+import httpx
+import openai
 import pytest
 
 from backend.app.ingest import (
+    _chunk_id,
+    _embed_all,
+    _embed_with_cache,
     _extract_title,
+    _positive_int_env,
     _split_by_headings,
     _split_section_by_paragraphs,
     chunk_markdown,
@@ -126,6 +135,20 @@ class TestSplitSectionByParagraphs:
         assert result[0].startswith("# T\n\n## H\n\n")
         assert huge_para in result[0]
 
+    def test_short_chunk_absorbs_next_paragraph_below_min_chars(self):
+        para_a = "A" * 30
+        para_b = "B" * 80
+        text = f"{para_a}\n\n{para_b}"
+        result = _split_section_by_paragraphs(text, "", "", 100, min_chars=50)
+        assert result == [f"{para_a}\n\n{para_b}"]
+
+    def test_chunk_at_min_chars_is_closed(self):
+        para_a = "A" * 60
+        para_b = "B" * 80
+        text = f"{para_a}\n\n{para_b}"
+        result = _split_section_by_paragraphs(text, "", "", 100, min_chars=50)
+        assert result == [para_a, para_b]
+
     def test_title_only_no_heading(self):
         result = _split_section_by_paragraphs("Body text.", "# Title", "", 1500)
         assert result[0].startswith("# Title\n\n")
@@ -257,3 +280,152 @@ class TestLoadMarkdownFiles:
         result = load_markdown_files(tmp_path)
         filenames = [r["filename"] for r in result]
         assert filenames == ["apple.md", "mango.md", "zebra.md"]
+
+
+# ---------------------------------------------------------------------------
+# _embed_all
+# ---------------------------------------------------------------------------
+
+
+def _fake_embeddings_response(*, model, input):
+    """Mimic client.embeddings.create: one vector per input, returned out of order."""
+    data = [SimpleNamespace(index=i, embedding=[float(len(text))]) for i, text in enumerate(input)]
+    return SimpleNamespace(data=list(reversed(data)))
+
+
+class TestEmbedAll:
+    def test_preserves_chunk_order_across_batches(self):
+        client = MagicMock()
+        client.embeddings.create = AsyncMock(side_effect=_fake_embeddings_response)
+        chunks = ["x" * n for n in range(1, 8)]
+
+        with patch("backend.app.ingest.EMBEDDING_BATCH_SIZE", 3):
+            result = asyncio.run(_embed_all(chunks, client))
+
+        assert result == [[float(n)] for n in range(1, 8)]
+        assert client.embeddings.create.call_count == 3
+
+    def test_batches_group_chunks_of_similar_length(self):
+        client = MagicMock()
+        client.embeddings.create = AsyncMock(side_effect=_fake_embeddings_response)
+        chunks = ["x" * 50, "x", "x" * 40, "x" * 2]
+
+        with patch("backend.app.ingest.EMBEDDING_BATCH_SIZE", 2):
+            result = asyncio.run(_embed_all(chunks, client))
+
+        sent = [call.kwargs["input"] for call in client.embeddings.create.call_args_list]
+        assert sorted(sent) == [["x", "xx"], ["x" * 40, "x" * 50]]
+        assert result == [[50.0], [1.0], [40.0], [2.0]]
+
+    def test_batches_are_capped_by_total_chars(self):
+        client = MagicMock()
+        client.embeddings.create = AsyncMock(side_effect=_fake_embeddings_response)
+        chunks = ["x" * 4, "x" * 6, "x" * 5, "x" * 20]
+
+        with patch("backend.app.ingest.EMBEDDING_BATCH_MAX_CHARS", 10):
+            result = asyncio.run(_embed_all(chunks, client))
+
+        sent = [call.kwargs["input"] for call in client.embeddings.create.call_args_list]
+        assert sorted(sent) == [["x" * 4, "x" * 5], ["x" * 6], ["x" * 20]]
+        assert result == [[4.0], [6.0], [5.0], [20.0]]
+
+    def test_retries_rate_limited_batch(self):
+        response = httpx.Response(
+            status_code=429,
+            request=httpx.Request("POST", "https://api.openai.com/v1/embeddings"),
+        )
+        rate_limited = openai.RateLimitError("Rate limit exceeded", response=response, body=None)
+        client = MagicMock()
+        client.embeddings.create = AsyncMock(
+            side_effect=[rate_limited, _fake_embeddings_response(model="m", input=["ab"])]
+        )
+
+        sleep = AsyncMock()
+
+        assert asyncio.run(_embed_all(["ab"], client, sleep=sleep)) == [[2.0]]
+        assert client.embeddings.create.call_count == 2
+        assert sleep.await_count == 1
+
+    def test_empty_input_makes_no_requests(self):
+        client = MagicMock()
+        client.embeddings.create = AsyncMock(side_effect=_fake_embeddings_response)
+        assert asyncio.run(_embed_all([], client)) == []
+        client.embeddings.create.assert_not_called()
+
+
+# ---------------------------------------------------------------------------
+# _embed_with_cache
+# ---------------------------------------------------------------------------
+
+
+class TestEmbedWithCache:
+    @staticmethod
+    async def _fake_embed(chunks, api_key):
+        return [[float(len(c)), 0.5] for c in chunks]
+
+    def test_second_run_is_served_from_cache(self, tmp_path):
+        cache = tmp_path / "cache.db"
+        with patch("backend.app.ingest._embed_with_new_client", side_effect=self._fake_embed) as mock_embed:
+            first = _embed_with_cache(["aa", "bbb"], "key", cache)
+            second = _embed_with_cache(["aa", "bbb"], "key", cache)
+
+        assert mock_embed.call_count == 1
+        assert [v.tolist() for v in first] == [[2.0, 0.5], [3.0, 0.5]]
+        assert [v.tolist() for v in second] == [[2.0, 0.5], [3.0, 0.5]]
+
+    def test_only_misses_are_embedded_and_duplicates_once(self, tmp_path):
+        cache = tmp_path / "cache.db"
+        with patch("backend.app.ingest._embed_with_new_client", side_effect=self._fake_embed) as mock_embed:
+            _embed_with_cache(["aa"], "key", cache)
+            result = _embed_with_cache(["aa", "cccc", "cccc"], "key", cache)
+
+        assert mock_embed.call_args_list[-1].args[0] == ["cccc"]
+        assert [v.tolist() for v in result] == [[2.0, 0.5], [4.0, 0.5], [4.0, 0.5]]
+
+    def test_cache_is_keyed_by_model(self, tmp_path):
+        cache = tmp_path / "cache.db"
+        with patch("backend.app.ingest._embed_with_new_client", side_effect=self._fake_embed) as mock_embed:
+            _embed_with_cache(["aa"], "key", cache)
+            with patch("backend.app.ingest.EMBEDDING_MODEL", "other-model"):
+                _embed_with_cache(["aa"], "key", cache)
+
+        assert mock_embed.call_count == 2
+
+
+# ---------------------------------------------------------------------------
+# _positive_int_env
+# ---------------------------------------------------------------------------
+
+
+class TestPositiveIntEnv:
+    def test_returns_default_when_unset(self, monkeypatch):
+        monkeypatch.delenv("CHROMA_BATCH_SIZE", raising=False)
+        assert _positive_int_env("CHROMA_BATCH_SIZE", 250) == 250
+
+    def test_reads_valid_value(self, monkeypatch):
+        monkeypatch.setenv("CHROMA_BATCH_SIZE", "100")
+        assert _positive_int_env("CHROMA_BATCH_SIZE", 250) == 100
+
+    @pytest.mark.parametrize("raw", ["0", "-5", "abc", ""])
+    def test_falls_back_on_invalid_value(self, monkeypatch, raw):
+        monkeypatch.setenv("CHROMA_BATCH_SIZE", raw)
+        assert _positive_int_env("CHROMA_BATCH_SIZE", 250) == 250
+
+
+# ---------------------------------------------------------------------------
+# _chunk_id
+# ---------------------------------------------------------------------------
+
+
+class TestChunkId:
+    def test_keeps_source_prefix_and_fixed_width_digest(self):
+        chunk_id = _chunk_id("guides/setup.md", "## Setup\n\nBody.")
+        source, digest = chunk_id.split("::")
+        assert source == "guides/setup.md"
+        assert len(digest) == 16
+        int(digest, 16)
+
+    def test_is_stable_and_content_addressed(self):
+        assert _chunk_id("a.md", "text") == _chunk_id("a.md", "text")
+        assert _chunk_id("a.md", "text") != _chunk_id("a.md", "other")
+        assert _chunk_id("a.md", "text") != _chunk_id("b.md", "text")
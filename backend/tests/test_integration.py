@@ -8,55 +8,25 @@ for real.  OpenAI LLM calls are still mocked.
 Fixtures are defined in conftest.py.
 """
 
-import json
-from unittest.mock import AsyncMock, MagicMock, patch
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+from .conftest import SEED_IDS
+from .openai_fakes import make_async_stream, make_mock_completion
+from .sse import aiter_sse_events, index_events, iter_sse_events, parse_sse_events
 
 
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
 
-def parse_sse_events(text: str) -> list[dict]:
-    """Parse a raw SSE response body into a list of {event, data} dicts."""
-    events = []
-    current: dict = {}
-    for line in text.splitlines():
-        if line.startswith("event:"):
-            current["event"] = line.split(":", 1)[1].strip()
-        elif line.startswith("data:"):
-            raw = line.split(":", 1)[1].strip()
-            try:
-                current["data"] = json.loads(raw)
-            except json.JSONDecodeError:
-                current["data"] = raw
-        elif line == "" and current:
-            events.append(current)
-            current = {}
-    if current:
-        events.append(current)
-    return events
-
-
-def make_mock_completion(text: str) -> MagicMock:
-    """Build a minimal mock for openai_client.chat.completions.create return value."""
-    choice = MagicMock()
-    choice.message.content = text
-    return MagicMock(choices=[choice])
-
-
-def make_async_stream(*tokens: str):
-    """Async generator that yields mock LLM stream chunks, then a content=None terminator."""
-    async def _stream():
-        for token in tokens:
-            chunk = MagicMock()
-            chunk.choices = [MagicMock()]
-            chunk.choices[0].delta.content = token
-            yield chunk
-        end = MagicMock()
-        end.choices = [MagicMock()]
-        end.choices[0].delta.content = None
-        yield end
-    return _stream()
+@pytest.fixture
+def _mock_async_openai(request):
+    """Patch async_openai_client once per test; tests configure ``self.mock_async``."""
+    with patch("backend.app.main.async_openai_client") as mock_async:
+        request.instance.mock_async = mock_async
+        yield
 
 
 # ---------------------------------------------------------------------------
@@ -65,11 +35,17 @@ def make_async_stream(*tokens: str):
 
 class TestRetrieveIntegration:
 
-    def test_retrieve_returns_all_docs_with_default_top_k(self, integration_client):
-        """Default top_k=5 with 3 docs in collection → returns all 3 results."""
-        res = integration_client.post("/retrieve", json={"query": "how to install"})
+    @pytest.mark.parametrize(
+        ("top_k", "expected_len"),
+        [(None, 3), (1, 1), (20, 3)],
+        ids=["default", "honored", "capped-by-collection"],
+    )
+    def test_retrieve_top_k(self, integration_client, top_k, expected_len):
+        """top_k limits the results; the default (5) and oversized values are capped at the 3 docs."""
+        body = {"query": "install"} if top_k is None else {"query": "install", "top_k": top_k}
+        res = integration_client.post("/retrieve", json=body)
         assert res.status_code == 200
-        assert len(res.json()["results"]) == 3
+        assert len(res.json()["results"]) == expected_len
 
     def test_retrieve_response_schema(self, integration_client):
         """Each result has doc_id (str), score (float in [0,1]), and text (str)."""
@@ -82,20 +58,8 @@ class TestRetrieveIntegration:
             assert isinstance(item["text"], str)
             assert len(item["text"]) > 0
 
-    def test_retrieve_top_k_honored(self, integration_client):
-        """top_k=1 → exactly 1 result returned."""
-        res = integration_client.post("/retrieve", json={"query": "install", "top_k": 1})
-        assert res.status_code == 200
-        assert len(res.json()["results"]) == 1
-
-    def test_retrieve_top_k_capped_by_collection_size(self, integration_client):
-        """top_k=20 (> 3 docs) is capped to the collection size (3)."""
-        res = integration_client.post("/retrieve", json={"query": "install", "top_k": 20})
-        assert res.status_code == 200
-        assert len(res.json()["results"]) == 3
-
     def test_retrieve_doc_ids_contain_separator(self, integration_client):
-        """All returned doc_ids follow the 'filename::index' format."""
+        """All returned doc_ids follow the '<path>::<blake2b hex>' format."""
         res = integration_client.post("/retrieve", json={"query": "install"})
         for item in res.json()["results"]:
             assert "::" in item["doc_id"], f"doc_id missing '::' separator: {item['doc_id']}"
@@ -111,13 +75,13 @@ class TestRetrieveIntegration:
 # /query integration tests
 # ---------------------------------------------------------------------------
 
+@pytest.mark.usefixtures("_mock_async_openai")
 class TestQueryIntegration:
 
     def test_query_response_schema(self, integration_client):
         """Response has answer (str), sources (list[str]), chunks (list)."""
-        with patch("backend.app.main.openai_client") as mock_openai:
-            mock_openai.chat.completions.create.return_value = make_mock_completion("ok")
-            res = integration_client.post("/query", json={"query": "how to install"})
+        self.mock_async.chat.completions.create = AsyncMock(return_value=make_mock_completion("ok"))
+        res = integration_client.post("/query", json={"query": "how to install"})
 
         assert res.status_code == 200
         data = res.json()
@@ -127,20 +91,16 @@ class TestQueryIntegration:
 
     def test_query_uses_real_retrieval(self, integration_client):
         """All 3 seeded doc_ids appear in chunks when top_k=5."""
-        with patch("backend.app.main.openai_client") as mock_openai:
-            mock_openai.chat.completions.create.return_value = make_mock_completion("ok")
-            res = integration_client.post("/query", json={"query": "install", "top_k": 5})
+        self.mock_async.chat.completions.create = AsyncMock(return_value=make_mock_completion("ok"))
+        res = integration_client.post("/query", json={"query": "install", "top_k": 5})
 
         doc_ids = [c["doc_id"] for c in res.json()["chunks"]]
-        assert "guide.md::chunk0" in doc_ids
-        assert "guide.md::chunk1" in doc_ids
-        assert "faq.md::chunk0" in doc_ids
+        assert sorted(doc_ids) == sorted(SEED_IDS)
 
     def test_query_sources_deduplicated(self, integration_client):
         """Two guide.md chunks → exactly one 'guide.md' in sources list."""
-        with patch("backend.app.main.openai_client") as mock_openai:
-            mock_openai.chat.completions.create.return_value = make_mock_completion("ok")
-            res = integration_client.post("/query", json={"query": "install", "top_k": 5})
+        self.mock_async.chat.completions.create = AsyncMock(return_value=make_mock_completion("ok"))
+        res = integration_client.post("/query", json={"query": "install", "top_k": 5})
 
         sources = res.json()["sources"]
         assert sources.count("guide.md") == 1, f"Duplicate guide.md in sources: {sources}"
@@ -148,9 +108,8 @@ class TestQueryIntegration:
 
     def test_query_sources_unique(self, integration_client):
         """No duplicate entries in the sources list."""
-        with patch("backend.app.main.openai_client") as mock_openai:
-            mock_openai.chat.completions.create.return_value = make_mock_completion("ok")
-            res = integration_client.post("/query", json={"query": "install", "top_k": 5})
+        self.mock_async.chat.completions.create = AsyncMock(return_value=make_mock_completion("ok"))
+        res = integration_client.post("/query", json={"query": "install", "top_k": 5})
 
         sources = res.json()["sources"]
         assert len(sources) == len(set(sources)), f"Duplicate sources: {sources}"
@@ -158,21 +117,24 @@ class TestQueryIntegration:
     def test_query_answer_from_mocked_llm(self, integration_client):
         """The answer field contains exactly the mocked LLM response."""
         expected = "Install using pip install mypackage."
-        with patch("backend.app.main.openai_client") as mock_openai:
-            mock_openai.chat.completions.create.return_value = make_mock_completion(expected)
-            res = integration_client.post("/query", json={"query": "how to install"})
+        self.mock_async.chat.completions.create = AsyncMock(return_value=make_mock_completion(expected))
+        res = integration_client.post("/query", json={"query": "how to install"})
 
         assert res.json()["answer"] == expected
 
-    def test_query_top_k_limits_chunks(self, integration_client):
-        """top_k=1 → exactly 1 chunk and 1 source returned."""
-        with patch("backend.app.main.openai_client") as mock_openai:
-            mock_openai.chat.completions.create.return_value = make_mock_completion("ok")
-            res = integration_client.post("/query", json={"query": "install", "top_k": 1})
+    @pytest.mark.parametrize(
+        ("top_k", "expected_chunks", "expected_sources"),
+        [(1, 1, 1), (20, 3, 2)],
+        ids=["honored", "capped-by-collection"],
+    )
+    def test_query_top_k_limits_chunks(self, integration_client, top_k, expected_chunks, expected_sources):
+        """top_k bounds the chunks returned; sources follow the distinct files among them."""
+        self.mock_async.chat.completions.create = AsyncMock(return_value=make_mock_completion("ok"))
+        res = integration_client.post("/query", json={"query": "install", "top_k": top_k})
 
         data = res.json()
-        assert len(data["chunks"]) == 1
-        assert len(data["sources"]) == 1
+        assert len(data["chunks"]) == expected_chunks
+        assert len(data["sources"]) == expected_sources
 
     def test_query_503_on_empty_collection(self, empty_integration_client):
         """Empty collection → 503 before the LLM is called."""
@@ -185,34 +147,35 @@ class TestQueryIntegration:
 # /query/stream integration tests
 # ---------------------------------------------------------------------------
 
+@pytest.mark.usefixtures("_mock_async_openai")
 class TestQueryStreamIntegration:
 
-    def test_stream_event_order(self, integration_client):
+    @pytest.mark.anyio
+    async def test_stream_event_order(self, async_integration_client):
         """Events arrive in order: metadata first, then token(s), then done last."""
-        with patch("backend.app.main.async_openai_client") as mock_async:
-            mock_async.chat.completions.create = AsyncMock(
-                return_value=make_async_stream("Hello", " world")
-            )
-            res = integration_client.post("/query/stream", json={"query": "install"})
-
-        assert res.status_code == 200
-        types = [e["event"] for e in parse_sse_events(res.text)]
-        assert types[0] == "metadata"
-        assert "token" in types
-        assert types[-1] == "done"
-        first_token = next(i for i, t in enumerate(types) if t == "token")
-        assert types.index("metadata") < first_token < types.index("done")
+        self.mock_async.chat.completions.create = AsyncMock(
+            return_value=make_async_stream("Hello", " world")
+        )
+        async with async_integration_client.stream(
+            "POST", "/query/stream", json={"query": "install"}
+        ) as res:
+            assert res.status_code == 200
+            events = [e async for e in aiter_sse_events(res, decode_data=False)]
+        idx = index_events(events)
+        assert idx["metadata"][0] is events[0]
+        assert idx["done"][-1] is events[-1]
+        first_token = events.index(idx["token"][0])
+        assert 0 < first_token < len(events) - 1
 
     def test_stream_metadata_payload(self, integration_client):
         """metadata event contains sources (list) and chunks (list with required keys)."""
-        with patch("backend.app.main.async_openai_client") as mock_async:
-            mock_async.chat.completions.create = AsyncMock(
-                return_value=make_async_stream("ok")
-            )
-            res = integration_client.post("/query/stream", json={"query": "install"})
-
-        events = parse_sse_events(res.text)
-        meta = next(e for e in events if e["event"] == "metadata")
+        self.mock_async.chat.completions.create = AsyncMock(
+            return_value=make_async_stream("ok")
+        )
+        with integration_client.stream("POST", "/query/stream", json={"query": "install"}) as res:
+            # metadata is the first event, so nothing past it needs to be read
+            meta = next(iter_sse_events(res))
+        assert meta["event"] == "metadata"
         data = meta["data"]
         assert isinstance(data["sources"], list)
         assert isinstance(data["chunks"], list)
@@ -224,61 +187,56 @@ class TestQueryStreamIntegration:
 
     def test_stream_metadata_sources_deduplicated(self, integration_client):
         """Sources in the metadata event are deduplicated (one 'guide.md')."""
-        with patch("backend.app.main.async_openai_client") as mock_async:
-            mock_async.chat.completions.create = AsyncMock(
-                return_value=make_async_stream("ok")
-            )
-            res = integration_client.post(
-                "/query/stream", json={"query": "install", "top_k": 5}
-            )
-
-        events = parse_sse_events(res.text)
-        meta = next(e for e in events if e["event"] == "metadata")
+        self.mock_async.chat.completions.create = AsyncMock(
+            return_value=make_async_stream("ok")
+        )
+        res = integration_client.post(
+            "/query/stream", json={"query": "install", "top_k": 5}
+        )
+
+        meta = index_events(parse_sse_events(res.text))["metadata"][0]
         sources = meta["data"]["sources"]
         assert sources.count("guide.md") == 1, f"Duplicate guide.md in sources: {sources}"
 
-    def test_stream_token_events(self, integration_client):
+    @pytest.mark.anyio
+    async def test_stream_token_events(self, async_integration_client):
         """Token events carry a 'text' key; count matches the non-None stream chunks."""
-        with patch("backend.app.main.async_openai_client") as mock_async:
-            mock_async.chat.completions.create = AsyncMock(
-                return_value=make_async_stream("Hello", " world")
-            )
-            res = integration_client.post("/query/stream", json={"query": "install"})
-
-        events = parse_sse_events(res.text)
-        token_events = [e for e in events if e["event"] == "token"]
+        self.mock_async.chat.completions.create = AsyncMock(
+            return_value=make_async_stream("Hello", " world")
+        )
+        async with async_integration_client.stream(
+            "POST", "/query/stream", json={"query": "install"}
+        ) as res:
+            token_events = index_events([e async for e in aiter_sse_events(res)])["token"]
         assert len(token_events) == 2
         assert token_events[0]["data"]["text"] == "Hello"
         assert token_events[1]["data"]["text"] == " world"
 
     def test_stream_done_event_payload(self, integration_client):
         """done event data is an empty dict {}."""
-        with patch("backend.app.main.async_openai_client") as mock_async:
-            mock_async.chat.completions.create = AsyncMock(
-                return_value=make_async_stream("ok")
-            )
-            res = integration_client.post("/query/stream", json={"query": "install"})
-
-        events = parse_sse_events(res.text)
-        done = next(e for e in events if e["event"] == "done")
+        self.mock_async.chat.completions.create = AsyncMock(
+            return_value=make_async_stream("ok")
+        )
+        res = integration_client.post("/query/stream", json={"query": "install"})
+
+        done = index_events(parse_sse_events(res.text))["done"][0]
         assert done["data"] == {}
 
     def test_stream_empty_collection_yields_error_event(self, empty_integration_client):
         """Empty collection → HTTP 200 with an SSE error event (not a 503)."""
-        res = empty_integration_client.post("/query/stream", json={"query": "anything"})
-        assert res.status_code == 200
-        events = parse_sse_events(res.text)
-        error_events = [e for e in events if e["event"] == "error"]
-        assert len(error_events) == 1
-        assert "No documents ingested" in error_events[0]["data"]["detail"]
+        with empty_integration_client.stream("POST", "/query/stream", json={"query": "anything"}) as res:
+            assert res.status_code == 200
+            events = iter_sse_events(res)
+            error = next(events)
+            assert error["event"] == "error"
+            assert "No documents ingested" in error["data"]["detail"]
+            assert next(events, None) is None
 
     def test_stream_no_error_events_on_success(self, integration_client):
         """A successful stream contains no error events."""
-        with patch("backend.app.main.async_openai_client") as mock_async:
-            mock_async.chat.completions.create = AsyncMock(
-                return_value=make_async_stream("ok")
-            )
-            res = integration_client.post("/query/stream", json={"query": "install"})
-
-        events = parse_sse_events(res.text)
-        assert [e for e in events if e["event"] == "error"] == []
+        self.mock_async.chat.completions.create = AsyncMock(
+            return_value=make_async_stream("ok")
+        )
+        res = integration_client.post("/query/stream", json={"query": "install"})
+
+        assert "error" not in index_events(parse_sse_events(res.text, decode_data=False))
@@ -1,30 +1,56 @@
+import asyncio
 import os
+import threading
+import time
+from types import MappingProxyType
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import httpx
+import numpy as np
 import openai
-
-os.environ.setdefault("OPENAI_API_KEY", "test-key")
-
 import pytest
+from fastapi import FastAPI, HTTPException
 from fastapi.testclient import TestClient
 
-from backend.app.main import app
-
-# Disable rate limiting in tests
-app.state.limiter._default_limits = []
-
-MOCK_QUERY_RESULTS = {
-    "ids": [["onboarding.md::chunk0", "onboarding.md::chunk1"]],
-    "distances": [[0.2, 0.4]],
-    "documents": [["First chunk text.", "Second chunk text."]],
-    "metadatas": [[{"section": "Intro", "chunk_index": 0}, {"section": "Setup", "chunk_index": 1}]],
-}
+from backend.app import ingest
+from backend.app.cors import StaticCORSMiddleware
+from backend.app.main import (
+    EMBEDDING_MODEL,
+    HNSW_METADATA,
+    EmbeddingBatcher,
+    Clock,
+    QueryEmbeddingCache,
+    _aembed_query,
+    _embed_query,
+    _hnsw_metadata_mismatch,
+    _openai_call_with_retry,
+    _query_embeddings,
+    get_doc,
+)
+
+from .openai_fakes import make_async_stream, make_mock_completion
+from .sse import index_events, parse_sse_events
+
+# Read-only: tuples and MappingProxyType, so an accidental in-place mutation in
+# the code under test fails loudly instead of leaking into later tests
+MOCK_QUERY_RESULTS = MappingProxyType({
+    "ids": (("onboarding.md::chunk0", "onboarding.md::chunk1"),),
+    "distances": ((0.2, 0.4),),
+    "documents": (("First chunk text.", "Second chunk text."),),
+    "metadatas": ((
+        MappingProxyType({"source": "onboarding.md", "section": "Intro", "chunk_index": 0}),
+        MappingProxyType({"source": "onboarding.md", "section": "Setup", "chunk_index": 1}),
+    ),),
+})
 
 
 @pytest.fixture
-def client():
-    return TestClient(app)
+def mock_collection():
+    """Patch the Chroma collection: 5 docs, returning MOCK_QUERY_RESULTS by default."""
+    with patch("backend.app.main.collection") as col:
+        col.count.return_value = 5
+        col.query.return_value = MOCK_QUERY_RESULTS
+        yield col
 
 
 # --- Health ---
@@ -36,6 +62,61 @@ def test_health(client):
     assert res.json() == {"status": "ok"}
 
 
+# --- CORS ---
+
+
+def test_cors_preflight_from_allowed_origin(client):
+    response = client.options(
+        "/retrieve",
+        headers={
+            "Origin": "http://localhost:5173",
+            "Access-Control-Request-Method": "POST",
+            "Access-Control-Request-Headers": "content-type",
+        },
+    )
+    assert response.status_code == 204
+    assert response.headers["access-control-allow-origin"] == "http://localhost:5173"
+    assert "POST" in response.headers["access-control-allow-methods"]
+
+
+def test_cors_preflight_from_unknown_origin_is_rejected(client):
+    response = client.options(
+        "/retrieve",
+        headers={"Origin": "http://evil.example", "Access-Control-Request-Method": "POST"},
+    )
+    assert response.status_code == 400
+    assert "access-control-allow-origin" not in response.headers
+
+
+def test_cors_headers_added_for_allowed_origin_only(client):
+    allowed = client.get("/health", headers={"Origin": "http://localhost:5173"})
+    assert allowed.headers["access-control-allow-origin"] == "http://localhost:5173"
+    assert allowed.headers["vary"] == "Origin"
+
+    assert "access-control-allow-origin" not in client.get("/health").headers
+    other = client.get("/health", headers={"Origin": "http://evil.example"})
+    assert "access-control-allow-origin" not in other.headers
+
+
+def test_cors_wildcard_allows_any_origin():
+    wildcard_app = FastAPI()
+    wildcard_app.get("/health")(lambda: {"status": "ok"})
+    wildcard_app.add_middleware(
+        StaticCORSMiddleware, allow_origins=["*"], allow_methods=["GET", "POST"], allow_headers=["Content-Type"]
+    )
+    c = TestClient(wildcard_app)
+
+    simple = c.get("/health", headers={"Origin": "http://anywhere.example"})
+    assert simple.headers["access-control-allow-origin"] == "*"
+
+    preflight = c.options(
+        "/health",
+        headers={"Origin": "http://anywhere.example", "Access-Control-Request-Method": "POST"},
+    )
+    assert preflight.status_code == 204
+    assert preflight.headers["access-control-allow-origin"] == "*"
+
+
 # --- /api/docs ---
 
 
@@ -48,6 +129,22 @@ def test_list_docs(client):
     assert all(name.endswith(".md") for name in data)
 
 
+def test_list_docs_refreshes_when_directory_changes(client, tmp_path):
+    (tmp_path / "b.md").write_text("B", encoding="utf-8")
+    with patch("backend.app.main.DOCS_DIR", tmp_path):
+        assert client.get("/api/docs").json() == ["b.md"]
+        (tmp_path / "a.md").write_text("A", encoding="utf-8")
+        os.utime(tmp_path, ns=(0, tmp_path.stat().st_mtime_ns + 1))
+        assert client.get("/api/docs").json() == ["a.md", "b.md"]
+
+
+def test_list_docs_missing_directory_is_empty(client, tmp_path):
+    with patch("backend.app.main.DOCS_DIR", tmp_path / "missing"):
+        res = client.get("/api/docs")
+    assert res.status_code == 200
+    assert res.json() == []
+
+
 def test_get_doc_valid(client):
     res = client.get("/api/docs/onboarding.md")
     assert res.status_code == 200
@@ -62,9 +159,18 @@ def test_get_doc_valid(client):
     "docs/../../secret.md",
     "file\\path.md",
 ])
-def test_get_doc_path_traversal(client, filename):
-    res = client.get(f"/api/docs/{filename}")
+def test_get_doc_path_traversal(filename):
+    # Rejected by a static name check, so call the endpoint function directly
+    with pytest.raises(HTTPException) as exc_info:
+        get_doc(filename)
+    assert exc_info.value.status_code == 404
+
+
+def test_get_doc_path_traversal_over_http(client):
+    # A backslash survives URL routing, so this reaches get_doc's own check
+    res = client.get("/api/docs/file\\path.md")
     assert res.status_code == 404
+    assert res.json()["detail"] == "Not found"
 
 
 def test_get_doc_not_found(client):
@@ -75,10 +181,7 @@ def test_get_doc_not_found(client):
 # --- /retrieve ---
 
 
-@patch("backend.app.main.collection")
-def test_retrieve(mock_col, client):
-    mock_col.count.return_value = 5
-    mock_col.query.return_value = MOCK_QUERY_RESULTS
+def test_retrieve(client, mock_collection):
     res = client.post("/retrieve", json={"query": "How do I onboard?"})
     assert res.status_code == 200
     data = res.json()
@@ -87,24 +190,232 @@ def test_retrieve(mock_col, client):
     assert data["results"][0]["score"] == 0.8
 
 
-@patch("backend.app.main.collection")
-def test_retrieve_empty_collection(mock_col, client):
-    mock_col.count.return_value = 0
+def test_retrieve_empty_collection(client, mock_collection):
+    mock_collection.count.return_value = 0
     res = client.post("/retrieve", json={"query": "test"})
     assert res.status_code == 503
 
 
-# --- /query ---
+def test_retrieve_passes_query_embedding(client, fake_query_embeddings, mock_collection):
+    client.post("/retrieve", json={"query": "How do I onboard?"})
+    fake_query_embeddings.assert_called_once_with(EMBEDDING_MODEL, "How do I onboard?")
+    assert "query_texts" not in mock_collection.query.call_args.kwargs
+    assert len(mock_collection.query.call_args.kwargs["query_embeddings"]) == 1
+    assert mock_collection.query.call_args.kwargs["include"] == ["documents", "distances"]
+
+
+def test_retrieve_without_text(client, mock_collection):
+    mock_collection.query.return_value = {**MOCK_QUERY_RESULTS, "documents": None}
+    res = client.post("/retrieve", json={"query": "How do I onboard?", "include_text": False})
+    assert res.status_code == 200
+    assert mock_collection.query.call_args.kwargs["include"] == ["distances"]
+    assert res.json()["results"][0] == {"doc_id": "onboarding.md::chunk0", "score": 0.8, "text": ""}
+
+
+def test_collection_count_cached_across_requests(client, mock_collection):
+    client.post("/retrieve", json={"query": "first"})
+    client.post("/retrieve", json={"query": "second"})
+    assert mock_collection.count.call_count == 1
+
+
+@pytest.fixture
+def openai_clients():
+    """Patch both OpenAI clients for tests that run the app lifespan themselves.
+
+    Shutdown closes the clients, so without this each ``with TestClient(app)``
+    would close the real module-level clients for the rest of the session.
+    Yields ``(async_client, sync_client)``.
+    """
+    with patch("backend.app.main.async_openai_client") as async_client, patch(
+        "backend.app.main.openai_client"
+    ) as sync_client:
+        async_client.close = AsyncMock()
+        yield async_client, sync_client
+
+
+def test_startup_primes_collection_count(app, mock_collection, openai_clients):
+    with TestClient(app) as c:
+        assert mock_collection.count.call_count == 1
+        c.post("/retrieve", json={"query": "first"})
+    assert mock_collection.count.call_count == 1
+
+
+def test_startup_warms_index_with_stored_embedding(app, mock_collection, openai_clients):
+    mock_collection.peek.return_value = {"embeddings": [[0.5, 0.5]]}
+    with TestClient(app):
+        mock_collection.query.assert_called_once_with(query_embeddings=[[0.5, 0.5]], n_results=1, include=[])
+
+
+def test_startup_survives_count_failure(app, mock_collection, openai_clients):
+    mock_collection.count.side_effect = RuntimeError("boom")
+    with TestClient(app) as c:
+        assert c.get("/health").status_code == 200
+    mock_collection.peek.assert_not_called()
+
+
+def test_startup_survives_warmup_failure(app, mock_collection, openai_clients):
+    mock_collection.peek.side_effect = RuntimeError("boom")
+    with TestClient(app) as c:
+        assert c.get("/health").status_code == 200
+
+
+def test_shutdown_closes_openai_clients(app, mock_collection, openai_clients):
+    mock_async_openai, mock_openai = openai_clients
+    mock_collection.count.return_value = 0
+    with TestClient(app):
+        mock_async_openai.close.assert_not_awaited()
+    mock_async_openai.close.assert_awaited_once()
+    mock_openai.close.assert_called_once()
+
+
+# --- Query embedding cache ---
+
+
+@pytest.fixture
+def empty_query_cache():
+    """Clear the module-wide query-embedding cache before and after the test."""
+    _query_embeddings.clear()
+    yield _query_embeddings
+    _query_embeddings.clear()
 
 
 @patch("backend.app.main.openai_client")
-@patch("backend.app.main.collection")
-def test_query(mock_col, mock_openai, client):
-    mock_col.count.return_value = 5
-    mock_col.query.return_value = MOCK_QUERY_RESULTS
-    choice = MagicMock()
-    choice.message.content = "Mocked answer."
-    mock_openai.chat.completions.create.return_value = MagicMock(choices=[choice])
+def test_embed_query_is_cached_per_model_and_query(mock_openai, empty_query_cache):
+    mock_openai.embeddings.create.return_value = MagicMock(data=[MagicMock(embedding=[0.5, 0.25])])
+
+    assert _embed_query("model-a", "hello").tolist() == [0.5, 0.25]
+    assert _embed_query("model-a", "hello").tolist() == [0.5, 0.25]
+    assert mock_openai.embeddings.create.call_count == 1
+
+    _embed_query("model-b", "hello")
+    _embed_query("model-a", "other")
+    assert mock_openai.embeddings.create.call_count == 3
+
+
+@patch("backend.app.main.openai_client")
+@patch("backend.app.main.async_openai_client")
+def test_async_and_sync_embedding_share_cache(mock_async_openai, mock_openai, empty_query_cache):
+    mock_async_openai.embeddings.create = AsyncMock(
+        return_value=MagicMock(data=[MagicMock(index=0, embedding=[0.75, 0.5])])
+    )
+
+    assert asyncio.run(_aembed_query("model-a", "hello")).tolist() == [0.75, 0.5]
+    assert _embed_query("model-a", "hello").tolist() == [0.75, 0.5]
+    assert mock_async_openai.embeddings.create.await_count == 1
+    mock_openai.embeddings.create.assert_not_called()
+
+
+@patch("backend.app.main.async_openai_client")
+def test_concurrent_query_embeddings_are_batched(mock_async_openai, empty_query_cache):
+
+    async def fake_create(model, input):
+        return MagicMock(
+            data=[MagicMock(index=i, embedding=[float(len(t))]) for i, t in enumerate(input)]
+        )
+
+    mock_async_openai.embeddings.create = AsyncMock(side_effect=fake_create)
+
+    async def run():
+        return await asyncio.gather(
+            _aembed_query("model-a", "a"),
+            _aembed_query("model-a", "bb"),
+            _aembed_query("model-a", "a"),
+        )
+
+    results = asyncio.run(run())
+    assert [r.tolist() for r in results] == [[1.0], [2.0], [1.0]]
+    mock_async_openai.embeddings.create.assert_awaited_once_with(model="model-a", input=["a", "bb"])
+
+
+@patch("backend.app.main.async_openai_client")
+def test_batched_embeddings_fail_all_waiters_on_short_response(mock_async_openai, empty_query_cache):
+    mock_async_openai.embeddings.create = AsyncMock(
+        return_value=MagicMock(data=[MagicMock(index=0, embedding=[1.0])])
+    )
+
+    async def run():
+        return await asyncio.wait_for(
+            asyncio.gather(
+                _aembed_query("model-a", "a"),
+                _aembed_query("model-a", "bb"),
+                return_exceptions=True,
+            ),
+            timeout=5,
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert _query_embeddings.get("model-a", "a") is None
+
+
+@patch("backend.app.main.async_openai_client")
+def test_batcher_fails_waiters_left_on_a_previous_loop(mock_async_openai):
+    async def fake_create(model, input):
+        return MagicMock(data=[MagicMock(index=i, embedding=[1.0]) for i in range(len(input))])
+
+    mock_async_openai.embeddings.create = AsyncMock(side_effect=fake_create)
+    batcher = EmbeddingBatcher(window_s=60, max_size=2)
+
+    old_loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=old_loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        stale = asyncio.run_coroutine_threadsafe(batcher.embed("model-a", "a"), old_loop)
+        while not batcher._pending:
+            time.sleep(0.001)
+
+        async def run():
+            return await asyncio.gather(batcher.embed("model-a", "b"), batcher.embed("model-a", "c"))
+
+        assert asyncio.run(run()) == [[1.0], [1.0]]
+        with pytest.raises(RuntimeError, match="event loop changed"):
+            stale.result(timeout=5)
+    finally:
+        old_loop.call_soon_threadsafe(old_loop.stop)
+        thread.join(timeout=5)
+        old_loop.close()
+
+
+def test_query_embedding_cache_evicts_least_recently_used():
+    cache = QueryEmbeddingCache(maxsize=2, ttl_s=60)
+    cache.put("m", "a", [1.0])
+    cache.put("m", "b", [2.0])
+    cache.get("m", "a")
+    cache.put("m", "c", [3.0])
+    assert cache.get("m", "a").tolist() == [1.0]
+    assert cache.get("m", "b") is None
+    assert cache.get("m", "c").tolist() == [3.0]
+
+
+def test_query_embedding_cache_stores_float32_and_expires():
+    cache = QueryEmbeddingCache(maxsize=8, ttl_s=60)
+    with patch("backend.app.main.time.monotonic", return_value=1000.0):
+        cache.put("m", "q", [0.1, 0.2])
+        vec = cache.get("m", "q")
+    assert vec.dtype == np.float32
+    assert not vec.flags.writeable
+    with patch("backend.app.main.time.monotonic", return_value=1061.0):
+        assert cache.get("m", "q") is None
+
+
+def test_hnsw_metadata_mismatch_reports_stale_settings():
+    assert _hnsw_metadata_mismatch(MagicMock(metadata=dict(HNSW_METADATA))) == {}
+
+    stale = MagicMock(metadata={**HNSW_METADATA, "hnsw:M": 16})
+    assert _hnsw_metadata_mismatch(stale) == {"hnsw:M": (16, HNSW_METADATA["hnsw:M"])}
+
+
+def test_hnsw_metadata_matches_ingest():
+    # The server and ingest each create the collection, so both must use the same index settings
+    assert HNSW_METADATA == ingest.HNSW_METADATA
+
+
+# --- /query ---
+
+
+@patch("backend.app.main.async_openai_client")
+def test_query(mock_openai, client, mock_collection):
+    mock_openai.chat.completions.create = AsyncMock(return_value=make_mock_completion("Mocked answer."))
 
     res = client.post("/query", json={"query": "How do I onboard?"})
     assert res.status_code == 200
@@ -114,19 +425,32 @@ def test_query(mock_col, mock_openai, client):
     assert len(data["chunks"]) == 2
 
 
-@patch("backend.app.main.collection")
-def test_query_empty_collection(mock_col, client):
-    mock_col.count.return_value = 0
+@patch("backend.app.main.async_openai_client")
+def test_query_system_prompt_contains_context(mock_openai, client, mock_collection):
+    mock_collection.query.return_value = {
+        **MOCK_QUERY_RESULTS,
+        "documents": [["Use {braces} literally.", "Second chunk text."]],
+    }
+    mock_openai.chat.completions.create = AsyncMock(return_value=make_mock_completion("ok"))
+
+    client.post("/query", json={"query": "How do I onboard?"})
+
+    messages = mock_openai.chat.completions.create.call_args.kwargs["messages"]
+    system = messages[0]["content"]
+    assert system.startswith("You are an internal documentation assistant.")
+    assert "[Source: onboarding.md]\nUse {braces} literally." in system
+    assert "{context}" not in system
+
+
+def test_query_empty_collection(client, mock_collection):
+    mock_collection.count.return_value = 0
     res = client.post("/query", json={"query": "test"})
     assert res.status_code == 503
 
 
-@patch("backend.app.main.openai_client")
-@patch("backend.app.main.collection")
-def test_query_openai_failure(mock_col, mock_openai, client):
-    mock_col.count.return_value = 5
-    mock_col.query.return_value = MOCK_QUERY_RESULTS
-    mock_openai.chat.completions.create.side_effect = Exception("API timeout")
+@patch("backend.app.main.async_openai_client")
+def test_query_openai_failure(mock_openai, client, mock_collection):
+    mock_openai.chat.completions.create = AsyncMock(side_effect=Exception("API timeout"))
 
     res = client.post("/query", json={"query": "test"})
     assert res.status_code == 503
@@ -136,107 +460,106 @@ def test_query_openai_failure(mock_col, mock_openai, client):
 # --- /query/stream ---
 
 
-@patch("backend.app.main.collection")
-def test_query_stream_empty_collection(mock_col, client):
-    mock_col.count.return_value = 0
+def test_query_stream_empty_collection(client, mock_collection):
+    mock_collection.count.return_value = 0
     res = client.post("/query/stream", json={"query": "test"})
     assert res.status_code == 200
-    assert "event: error" in res.text
-    assert "No documents ingested yet" in res.text
+    events = index_events(parse_sse_events(res.text))
+    assert "No documents ingested yet" in events["error"][0]["data"]["detail"]
 
 
 @patch("backend.app.main.async_openai_client")
-@patch("backend.app.main.collection")
-def test_query_stream_success(mock_col, mock_openai, client):
-    mock_col.count.return_value = 5
-    mock_col.query.return_value = MOCK_QUERY_RESULTS
-
-    token_chunk = MagicMock()
-    token_chunk.choices = [MagicMock()]
-    token_chunk.choices[0].delta.content = "Hello"
-    end_chunk = MagicMock()
-    end_chunk.choices = [MagicMock()]
-    end_chunk.choices[0].delta.content = None
+def test_query_stream_success(mock_openai, client, mock_collection):
 
-    async def async_stream():
-        yield token_chunk
-        yield end_chunk
-
-    mock_openai.chat.completions.create = AsyncMock(return_value=async_stream())
+    mock_openai.chat.completions.create = AsyncMock(return_value=make_async_stream("Hello"))
 
     res = client.post("/query/stream", json={"query": "How do I onboard?"})
     assert res.status_code == 200
-    assert "event: metadata" in res.text
-    assert "onboarding.md" in res.text
-    assert "event: token" in res.text
-    assert "Hello" in res.text
-    assert "event: done" in res.text
+    events = index_events(parse_sse_events(res.text))
+    assert {"metadata", "token", "done"} <= events.keys()
+    assert events["metadata"][0]["data"]["sources"] == ["onboarding.md"]
+    assert "".join(e["data"]["text"] for e in events["token"]) == "Hello"
 
 
-@patch("backend.app.main.collection")
-def test_query_stream_vector_search_failure(mock_col, client):
-    mock_col.count.return_value = 5
-    mock_col.query.side_effect = Exception("ChromaDB error")
+def test_query_stream_vector_search_failure(client, mock_collection):
+    mock_collection.query.side_effect = Exception("ChromaDB error")
 
     res = client.post("/query/stream", json={"query": "test"})
     assert res.status_code == 200
-    assert "event: error" in res.text
-    assert "Vector search failed" in res.text
+    events = index_events(parse_sse_events(res.text))
+    assert "Vector search failed" in events["error"][0]["data"]["detail"]
 
 
 @patch("backend.app.main.async_openai_client")
-@patch("backend.app.main.collection")
-def test_query_stream_openai_failure(mock_col, mock_openai, client):
-    mock_col.count.return_value = 5
-    mock_col.query.return_value = MOCK_QUERY_RESULTS
+def test_query_stream_openai_failure(mock_openai, client, mock_collection):
     mock_openai.chat.completions.create = AsyncMock(side_effect=Exception("API timeout"))
 
     res = client.post("/query/stream", json={"query": "test"})
     assert res.status_code == 200
-    assert "event: error" in res.text
-    assert "LLM request failed" in res.text
+    events = index_events(parse_sse_events(res.text))
+    assert "LLM request failed" in events["error"][0]["data"]["detail"]
 
 
 # --- Retry with exponential backoff ---
 
 
-def _make_rate_limit_error():
-    """Construct an openai.RateLimitError with a minimal httpx response."""
-    response = httpx.Response(
+# Built once and raised as-is by every retry test's side_effect
+_RATE_LIMIT_ERROR = openai.RateLimitError(
+    "Rate limit exceeded",
+    response=httpx.Response(
         status_code=429,
         request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"),
-    )
-    return openai.RateLimitError("Rate limit exceeded", response=response, body=None)
+    ),
+    body=None,
+)
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    """Make the default retry clock sleep with recording no-ops; returns the clock."""
+    clock = Clock(sleep=MagicMock(), async_sleep=AsyncMock())
+    monkeypatch.setattr("backend.app.main._default_clock", clock)
+    return clock
 
 
-@patch("time.sleep")
 @patch("backend.app.main.OPENAI_MAX_RETRIES", 3)
-@patch("backend.app.main.openai_client")
-@patch("backend.app.main.collection")
-def test_query_retries_on_rate_limit_and_succeeds(mock_col, mock_openai, mock_sleep, client):
-    mock_col.count.return_value = 5
-    mock_col.query.return_value = MOCK_QUERY_RESULTS
-    choice = MagicMock()
-    choice.message.content = "Mocked answer."
-    success = MagicMock(choices=[choice])
-    mock_openai.chat.completions.create.side_effect = [_make_rate_limit_error(), success]
+def test_sync_retry_helper_retries_then_succeeds():
+    clock = Clock(sleep=MagicMock())
+    fn = MagicMock(side_effect=[_RATE_LIMIT_ERROR, "ok"])
+    assert _openai_call_with_retry(fn, clock=clock) == "ok"
+    assert fn.call_count == 2
+    assert clock.sleep.call_count == 1
+
+
+@patch("backend.app.main.OPENAI_MAX_RETRIES", 3)
+def test_sync_retry_helper_does_not_retry_other_errors():
+    clock = Clock(sleep=MagicMock())
+    fn = MagicMock(side_effect=ValueError("bad request"))
+    with pytest.raises(ValueError):
+        _openai_call_with_retry(fn, clock=clock)
+    assert fn.call_count == 1
+    assert not clock.sleep.called
+
+
+@patch("backend.app.main.OPENAI_MAX_RETRIES", 3)
+@patch("backend.app.main.async_openai_client")
+def test_query_retries_on_rate_limit_and_succeeds(mock_openai, client, mock_collection, no_backoff):
+    mock_openai.chat.completions.create = AsyncMock(
+        side_effect=[_RATE_LIMIT_ERROR, make_mock_completion("Mocked answer.")]
+    )
 
     res = client.post("/query", json={"query": "How do I onboard?"})
 
     assert res.status_code == 200
     assert res.json()["answer"] == "Mocked answer."
     assert mock_openai.chat.completions.create.call_count == 2
-    assert mock_sleep.called
+    assert no_backoff.async_sleep.called
 
 
-@patch("time.sleep")
 @patch("backend.app.main.OPENAI_MAX_RETRIES", 2)
-@patch("backend.app.main.openai_client")
-@patch("backend.app.main.collection")
-def test_query_exhausts_retries(mock_col, mock_openai, mock_sleep, client):
-    mock_col.count.return_value = 5
-    mock_col.query.return_value = MOCK_QUERY_RESULTS
-    mock_openai.chat.completions.create.side_effect = _make_rate_limit_error()
+@patch("backend.app.main.async_openai_client")
+def test_query_exhausts_retries(mock_openai, client, mock_collection, no_backoff):
+    mock_openai.chat.completions.create = AsyncMock(side_effect=_RATE_LIMIT_ERROR)
 
     res = client.post("/query", json={"query": "test"})
 
@@ -245,51 +568,31 @@ def test_query_exhausts_retries(mock_col, mock_openai, mock_sleep, client):
     assert mock_openai.chat.completions.create.call_count == 2
 
 
-@patch("asyncio.sleep", new_callable=AsyncMock)
 @patch("backend.app.main.OPENAI_MAX_RETRIES", 3)
 @patch("backend.app.main.async_openai_client")
-@patch("backend.app.main.collection")
-def test_query_stream_retries_on_rate_limit_and_succeeds(mock_col, mock_openai, mock_sleep, client):
-    mock_col.count.return_value = 5
-    mock_col.query.return_value = MOCK_QUERY_RESULTS
-
-    token_chunk = MagicMock()
-    token_chunk.choices = [MagicMock()]
-    token_chunk.choices[0].delta.content = "Hello"
-    end_chunk = MagicMock()
-    end_chunk.choices = [MagicMock()]
-    end_chunk.choices[0].delta.content = None
-
-    async def async_stream():
-        yield token_chunk
-        yield end_chunk
-
+def test_query_stream_retries_on_rate_limit_and_succeeds(mock_openai, client, mock_collection, no_backoff):
     mock_openai.chat.completions.create = AsyncMock(
-        side_effect=[_make_rate_limit_error(), async_stream()]
+        side_effect=[_RATE_LIMIT_ERROR, make_async_stream("Hello")]
     )
 
     res = client.post("/query/stream", json={"query": "How do I onboard?"})
 
     assert res.status_code == 200
-    assert "event: token" in res.text
-    assert "Hello" in res.text
+    tokens = index_events(parse_sse_events(res.text))["token"]
+    assert "".join(e["data"]["text"] for e in tokens) == "Hello"
     assert mock_openai.chat.completions.create.call_count == 2
-    assert mock_sleep.called
+    assert no_backoff.async_sleep.called
 
 
-@patch("asyncio.sleep", new_callable=AsyncMock)
 @patch("backend.app.main.OPENAI_MAX_RETRIES", 2)
 @patch("backend.app.main.async_openai_client")
-@patch("backend.app.main.collection")
-def test_query_stream_exhausts_retries(mock_col, mock_openai, mock_sleep, client):
-    mock_col.count.return_value = 5
-    mock_col.query.return_value = MOCK_QUERY_RESULTS
-    mock_openai.chat.completions.create = AsyncMock(side_effect=_make_rate_limit_error())
+def test_query_stream_exhausts_retries(mock_openai, client, mock_collection, no_backoff):
+    mock_openai.chat.completions.create = AsyncMock(side_effect=_RATE_LIMIT_ERROR)
 
     res = client.post("/query/stream", json={"query": "test"})
 
     assert res.status_code == 200
-    assert "event: error" in res.text
-    assert "LLM request failed" in res.text
+    events = index_events(parse_sse_events(res.text))
+    assert "LLM request failed" in events["error"][0]["data"]["detail"]
     assert mock_openai.chat.completions.create.call_count == 2
 